@@ -24,6 +24,12 @@ brightness, saturation and opacity into different sounds.
 """
 # See README.txt for more information.
 
+import os
+
+# pygame prints a banner to standard out when imported, where pumila may be
+# writing the sound; every import of pygame in pumila comes after this
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
 from . import info
 
 __version__ = info.program.version.text
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+# pumila: convert images to sound waves
+# Copyright (C) 2011 Niels Serup
+
+# This file is part of pumila.
+
+# pumila is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# pumila is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with pumila.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Renders many sounds in one go.
+
+A manifest lists one job per line: the output file and then the input specs
+(as given on the command line, settings included), separated by tabs. Empty
+lines and lines starting with '#' are ignored.
+"""
+
+import os
+import time
+import multiprocessing
+
+from . import core
+from . import misc
+from . import info
+
+_selfdict, log = misc.get_selfdict(__name__), misc.newlog('batch')
+info.add_metadata(_selfdict)
+
+def parse_inputspec(spec):
+    """
+    parse_inputspec(spec: str) -> str or (str, dict) or None
+
+    Split an input spec like 'test.png/gain=0.5,min=300 Hz' into the path and
+    a dict of unparsed settings. A spec that is an existing path is returned
+    as it is, and one that is neither that nor has settings gives None.
+    """
+    if os.path.exists(spec):
+        return spec
+    if '/' not in spec:
+        return None
+    path, settings = spec.rsplit('/', 1)
+    return (path, {k.strip(): v.strip() for k, v in (
+                x.split('=', 1) for x in settings.split(','))})
+
+def read_manifest(f):
+    """
+    read_manifest(f: file) -> [(str, [str or (str, dict)])]
+
+    Read the jobs of a manifest as (output file, inputs) pairs.
+    """
+    jobs = []
+    for num, line in enumerate(f, 1):
+        line = line.rstrip('\r\n')
+        if not line.strip() or line.lstrip().startswith('#'):
+            continue
+        fields = [x for x in line.split('\t') if x.strip()]
+        if len(fields) < 2:
+            raise ValueError('line {} of the manifest has no input'.format(num))
+        inputs = [parse_inputspec(x) for x in fields[1:]]
+        if None in inputs:
+            raise ValueError('line {}: {} does not exist'.format(
+                    num, repr(fields[1 + inputs.index(None)])))
+        jobs.append((fields[0], inputs))
+    return jobs
+
+def _render(args):
+    # Render one job in a worker process; the processes live for the whole
+    # batch, so what the core module memoizes is shared by their jobs.
+    num, outputfile, inputs, options = args
+    start = time.time()
+    cpu_start = time.process_time()
+    try:
+        sc = core.SoundCore(*inputs, outputfile=outputfile, **options)
+        try:
+            sc.run()
+        finally:
+            sc.end()
+    except Exception as e:
+        return (num, None, time.time() - start,
+                time.process_time() - cpu_start, str(e) or repr(e))
+    return (num, float(sc.fullduration) / 1000, time.time() - start,
+            time.process_time() - cpu_start, None)
+
+class Batch:
+    def __init__(self, jobs, processes=None, verbose=False, **options):
+        """
+        Render jobs, a list of (output file, inputs) pairs, with processes
+        worker processes (by default one per CPU). Every job is rendered by
+        a SoundCore created with the keyword arguments options; they cannot
+        ask for playback.
+
+        After run, results holds a (sound seconds or None, seconds, CPU
+        seconds, error or None) tuple for each job.
+        """
+        if options.get('play') or options.get('playatonce'):
+            raise ValueError('a batch cannot play sound')
+        if any(outputfile == '-' for outputfile, inputs in jobs):
+            raise ValueError('a batch cannot write to standard out')
+        self.jobs, self.options = jobs, options
+        self.processes = processes or multiprocessing.cpu_count()
+        self.options['verbose'] = False
+        self.options['showprogressbar'] = False
+        self.options['workers'] = 1
+        self.log = log if verbose else misc.donothing
+        self.results = [None] * len(jobs)
+
+    def run(self):
+        """Render the jobs, logging each one and a summary."""
+        self.log('Rendering {} jobs in {} processes...'.format(
+                len(self.jobs), self.processes))
+        start = time.time()
+        pool = multiprocessing.Pool(min(self.processes, len(self.jobs)) or 1)
+        try:
+            for num, sound, seconds, cpu, error in pool.imap_unordered(
+                _render, ((num, outputfile, inputs, self.options) for
+                          num, (outputfile, inputs) in enumerate(self.jobs))):
+                self.results[num] = (sound, seconds, cpu, error)
+                if error is not None:
+                    log('{} failed after {:.2f} s: {}'.format(
+                            repr(self.jobs[num][0]), seconds, error),
+                        error=True)
+                else:
+                    self.log('Rendered {} ({:.2f} s of sound) in {:.2f} s, '
+                             '{:.1f}x real time.'.format(
+                            repr(self.jobs[num][0]), sound, seconds,
+                            sound / seconds if seconds else 0))
+        finally:
+            pool.terminate()
+            pool.join()
+        self.seconds = time.time() - start
+        done = [x for x in self.results if x[3] is None]
+        sound = sum(x[0] for x in done)
+        self.log('Rendered {} of {} jobs ({:.2f} s of sound) in {:.2f} s: '
+                 '{:.2f} jobs/s, {:.1f}x real time, {:.2f} CPU seconds per '
+                 'job.'.format(
+                len(done), len(self.jobs), sound, self.seconds,
+                len(done) / self.seconds if self.seconds else 0,
+                sound / self.seconds if self.seconds else 0,
+                sum(x[2] for x in done) / len(done) if done else 0))
+        if len(done) < len(self.jobs):
+            raise ValueError('{} of {} jobs failed'.format(
+                    len(self.jobs) - len(done), len(self.jobs)))
+
+    def end(self):
+        """Finalize objects."""
+        pass
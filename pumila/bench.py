@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+
+# pumila: convert images to sound waves
+# Copyright (C) 2011 Niels Serup
+
+# This file is part of pumila.
+
+# pumila is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# pumila is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with pumila.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmarks of the time-consuming parts of pumila.
+
+Every benchmark runs on synthetic images of a configurable size, generated
+from a fixed seed, and is repeated a number of times; the fastest run counts.
+Results are reported as JSON with samples and pixels per second.
+"""
+
+import sys
+import os
+import io
+import json
+import time
+import wave
+import shutil
+import zipfile
+import tempfile
+from optparse import OptionParser
+import numpy
+
+from . import core
+from . import image
+from . import primitives
+from . import generate
+from . import misc
+from . import info
+
+info.add_metadata(misc.get_selfdict(__name__))
+
+def make_image(path, width, height, transparency=0.5, seed=0, red=False):
+    """
+    Save a random image of width x height pixels as PNG to path. A fraction of
+    about transparency of its pixels is fully transparent. If red, the pixels
+    are shades of red, which sound as pure sines.
+    """
+    rand = numpy.random.RandomState(seed)
+    rgb = rand.randint(0, 256, (width, height, 3))
+    if red:
+        rgb[:, :, 1:] = 0
+    alpha = rand.randint(1, 256, (width, height))
+    alpha[rand.random_sample((width, height)) < transparency] = 0
+    image.save_png(path, rgb, alpha)
+
+def make_ora(path, width, height, layers=2, transparency=0.5, seed=0):
+    """Save an OpenRaster file of random layers made by make_image to path."""
+    temp = tempfile.mkdtemp()
+    try:
+        srcs = []
+        for i in range(layers):
+            name = 'data/layer{:03d}.png'.format(i)
+            make_image(os.path.join(temp, 'layer.png'), width, height,
+                       transparency, seed + i)
+            with open(os.path.join(temp, 'layer.png'), 'rb') as f:
+                srcs.append((name, f.read()))
+        with zipfile.ZipFile(path, 'w') as zf:
+            zf.writestr('mimetype', 'image/openraster')
+            zf.writestr('stack.xml', '''\
+<?xml version='1.0' encoding='UTF-8'?>
+<image h="{}" w="{}">
+  <stack>
+{}
+  </stack>
+</image>
+'''.format(height, width, '\n'.join(
+                        '    <layer opacity="1.0" src="{}" visibility="visible" '
+                        'x="0" y="0" />'.format(name) for name, data in srcs)))
+            for name, data in srcs:
+                zf.writestr(name, data)
+    finally:
+        shutil.rmtree(temp)
+
+def best_time(func, repeat):
+    """Run func repeat times and return the shortest time in seconds."""
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        func()
+        diff = time.time() - start
+        if best is None or diff < best:
+            best = diff
+    return best
+
+def _result(seconds, samples=None, pixels=None):
+    result = {'seconds': seconds}
+    if samples is not None:
+        result['samples'] = samples
+        result['samples_per_sec'] = samples / seconds if seconds else None
+    if pixels is not None:
+        result['pixels'] = pixels
+        result['pixels_per_sec'] = pixels / seconds if seconds else None
+    return result
+
+def _core(path, **kwds):
+    kwds.setdefault('pixelduration', 10)
+    return core.SoundCore(path, outputfile=None, cache=False, **kwds)
+
+def bench_synthesis(path, width, height, repeat, engine='numpy', **kwds):
+    """Time the generation of all samples, without any output."""
+    def run():
+        sc = _core(path, engine=engine, **kwds)
+        sc.run()
+        sc.end()
+        run.samples = sc.samples_len
+    seconds = best_time(run, repeat)
+    return _result(seconds, run.samples, width * height)
+
+def bench_wavefunc(path, width, height, repeat):
+    """Time rgbafg_to_wavefunc for every pixel (the python engine's setup)."""
+    sc = _core(path, returndata=True)
+    sc.run()
+    rgb, alpha, freqs = sc.rgbs[0], sc.alphas[0], sc.freq_range[0]
+    pixels = [(int(r), int(g), int(b), int(a), freqs[y])
+              for x in range(width) for y in range(height)
+              for (r, g, b), a in ((rgb[x, y], alpha[x, y]),)]
+    def run():
+        for r, g, b, a, freq in pixels:
+            sc.rgbafg_to_wavefunc(r, g, b, a, freq, 1.0)
+    return _result(best_time(run, repeat), pixels=width * height)
+
+def bench_primitives(samples, repeat):
+    """Time every wave, one sample at a time and as one array."""
+    results = {}
+    lengths = primitives.getlengths(440.0)
+    t = numpy.arange(samples) / 44100.
+    for name in ('sine', 'triangle', 'square', 'sawtooth'):
+        wave, wave_array = getattr(primitives, name), \
+            getattr(primitives, name + '_array')
+        times = t.tolist()
+        def run():
+            for x in times:
+                wave(x, 440.0, *lengths)
+        results[name] = _result(best_time(run, repeat), samples)
+        results[name + '_array'] = _result(best_time(
+                lambda: wave_array(t, 440.0, *lengths), repeat), samples)
+    bank = primitives.WavetableBank([440.0], 44100)
+    for k, name in enumerate(('sine', 'triangle', 'square', 'sawtooth')):
+        results[name + '_wavetable'] = _result(best_time(
+                lambda: bank.render(k, [0], 0, samples), repeat), samples)
+    return results
+
+def bench_wav(samples, repeat, sampleformat='s16', blocksize=4096):
+    """Time converting and writing samples to a WAVE file in memory."""
+    data = numpy.random.RandomState(0).uniform(-1, 1, samples)
+    def run():
+        wf = wave.open(io.BytesIO(), 'w')
+        wf.setnchannels(1)
+        wf.setsampwidth(generate.sample_formats[sampleformat][0] // 8)
+        wf.setframerate(44100)
+        for i in range(0, samples, blocksize):
+            wf.writeframesraw(generate.to_bytes(data[i:i + blocksize],
+                                                sampleformat))
+    return _result(best_time(run, repeat), samples)
+
+def bench_load(path, width, height, repeat, layers=1, backend=None):
+    """Time image.load of a PNG or OpenRaster file."""
+    return _result(best_time(lambda: image.load(path, backend), repeat),
+                   pixels=width * height * layers)
+
+# The heights of the images of the rows and sines benchmarks, whose pixels
+# are all audible (and, for sines, pure sines), so that the engines can be
+# compared as the number of rows grows
+dense_rows = (16, 64, 256, 1024)
+_dense_width = 32
+
+def run_benchmarks(width=256, height=128, pixelduration=10, repeat=3,
+                   engines=('numpy', 'wavetable', 'fft'), only=None,
+                   log=misc.donothing):
+    """
+    Run the benchmarks on synthetic images of width x height pixels and return
+    the results as a dict. If only is given, only run the benchmarks whose
+    names start with one of its strings. The rows and sines benchmarks use
+    images of the heights in dense_rows instead.
+    """
+    temp = tempfile.mkdtemp()
+    png = os.path.join(temp, 'bench.png')
+    ora = os.path.join(temp, 'bench.ora')
+    make_image(png, width, height)
+    make_ora(ora, width, height)
+    samples = int(width * pixelduration * 44100 / 1000)
+    benchmarks = [('synthesis_' + engine, bench_synthesis,
+                   (png, width, height, repeat, engine),
+                   {'pixelduration': pixelduration}) for engine in engines]
+    benchmarks += [
+        ('wavefunc', bench_wavefunc, (png, width, height, repeat), {}),
+        ('primitives', bench_primitives, (min(samples, 100000), repeat), {}),
+        ('wav_s16', bench_wav, (samples, repeat, 's16'), {}),
+        ('wav_f32', bench_wav, (samples, repeat, 'f32'), {}),
+        ('load_png', bench_load, (png, width, height, repeat), {}),
+        ('load_ora', bench_load, (ora, width, height, repeat, 2), {}),
+        ]
+    for name, red in (('rows', False), ('sines', True)):
+        for rows in dense_rows:
+            path = os.path.join(temp, '{}{}.png'.format(name, rows))
+            make_image(path, _dense_width, rows, transparency=0, red=red)
+            benchmarks += [('{}_{}_{}'.format(name, rows, engine),
+                            bench_synthesis,
+                            (path, _dense_width, rows, repeat, engine),
+                            {'pixelduration': pixelduration})
+                           for engine in engines]
+    for backend in image.backends:
+        try:
+            image.available_backend(backend)
+        except ValueError:
+            continue
+        benchmarks.append(('load_png_' + backend, bench_load,
+                           (png, width, height, repeat),
+                           {'backend': backend}))
+    results = {}
+    try:
+        for name, func, args, kwds in benchmarks:
+            if only and not any(name.startswith(x) for x in only):
+                continue
+            log('Running {}...'.format(name))
+            results[name] = func(*args, **kwds)
+    finally:
+        shutil.rmtree(temp)
+    return {'program': info.program.name,
+            'version': info.program.version.text,
+            'width': width, 'height': height, 'pixelduration': pixelduration,
+            'repeat': repeat, 'results': results}
+
+def parse_args(cmdargs=None):
+    """
+    parse_args(cmdargs: [str] = sys.argv[1:]) -> dict
+
+    Run the benchmarks chosen on the command line and print them as JSON.
+    """
+    if cmdargs is None:
+        cmdargs = sys.argv[1:]
+
+    parser = OptionParser(
+        prog='pumila-bench', usage='Usage: %prog [OPTION]... [BENCHMARK]...',
+        version=info.program.version_info,
+        description='Benchmark pumila on synthetic images. If BENCHMARKs '
+        'are given, only run the benchmarks whose names start with them.')
+    parser.add_option('-W', '--width', dest='width', type='int', default=256,
+                      help='the width of the images. Defaults to 256.')
+    parser.add_option('-H', '--height', dest='height', type='int',
+                      default=128,
+                      help='the height of the images. Defaults to 128.')
+    parser.add_option('-d', '--pixel-duration', dest='pixelduration',
+                      type='int', default=10, metavar='MILLISECONDS',
+                      help='how long one column lasts. Defaults to 10 ms.')
+    parser.add_option('-n', '--repeat', dest='repeat', type='int', default=3,
+                      help='how many times to run every benchmark; the '
+                      'fastest run counts. Defaults to 3.')
+    parser.add_option('-e', '--engine', dest='engines', action='append',
+                      type='choice', choices=generate.engines, metavar='ENGINE',
+                      help='an engine to benchmark the synthesis of. Can be '
+                      'given more than once. Defaults to numpy, wavetable '
+                      'and fft.')
+    parser.add_option('-o', '--output-file', dest='outputfile',
+                      metavar='FILENAME',
+                      help='write the results to FILENAME instead of standard '
+                      'out.')
+    parser.add_option('-q', '--quiet', dest='verbose', action='store_false',
+                      default=True, help='do not print progress.')
+
+    o, args = parser.parse_args(cmdargs)
+    results = run_benchmarks(
+        o.width, o.height, o.pixelduration, o.repeat,
+        o.engines or ('numpy', 'wavetable', 'fft'), args,
+        misc.newlog('bench') if o.verbose else misc.donothing)
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if o.outputfile:
+        with open(o.outputfile, 'w') as f:
+            print(text, file=f)
+    else:
+        print(text)
+    return results
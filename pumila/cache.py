@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+# pumila: convert images to sound waves
+# Copyright (C) 2011 Niels Serup
+
+# This file is part of pumila.
+
+# pumila is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# pumila is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with pumila.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Caches generated sound on disk.
+"""
+
+import os
+import hashlib
+import tempfile
+import numpy
+
+from . import misc
+from . import info
+
+_selfdict, log = misc.get_selfdict(__name__), misc.newlog('cache')
+info.add_metadata(_selfdict)
+
+# How many columns of an image to hash at a time
+_strip_width = 256
+
+class RenderCache:
+    """
+    A directory of generated sounds, named by a hash of everything they
+    depend on. When the files take up more than maxsize bytes, the least
+    recently used ones are deleted.
+    """
+
+    def __init__(self, directory=None, maxsize=2 ** 30):
+        self.directory = directory or info.localpaths.dirs.cache
+        self.maxsize = maxsize
+
+    def key(self, images, params):
+        """
+        key(images: [((rgb, alpha), settings)], params: tuple) -> str
+
+        Hash the pixel data and settings of every image and the render
+        parameters params.
+        """
+        h = hashlib.sha256(repr(params).encode())
+        for (rgb, alpha), settings in images:
+            h.update(repr((rgb.shape, sorted(settings.items()))).encode())
+            for x in range(0, len(alpha), _strip_width):
+                h.update(numpy.ascontiguousarray(rgb[x:x + _strip_width]))
+                h.update(numpy.ascontiguousarray(alpha[x:x + _strip_width]))
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.pcm')
+
+    def open(self, key):
+        """Open the sound with key for reading, or return None if missing."""
+        path = self._path(key)
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            return None
+        os.utime(path)
+        return f
+
+    def writer(self, key):
+        """Get a CacheEntry that stores a sound under key when committed."""
+        os.makedirs(self.directory, exist_ok=True)
+        return CacheEntry(self, key)
+
+    def evict(self):
+        """Delete the least recently used sounds until the cache fits."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.pcm'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        total = sum(x[1] for x in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.maxsize:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+class CacheEntry:
+    """
+    A sound being written to a RenderCache. It is written to a temporary file
+    and only shows up in the cache when committed.
+    """
+
+    def __init__(self, cache, key):
+        self.cache, self.key = cache, key
+        fd, self._temp = tempfile.mkstemp(dir=cache.directory, suffix='.tmp')
+        self._file = os.fdopen(fd, 'wb')
+
+    def write(self, data):
+        self._file.write(data)
+
+    def commit(self):
+        """Add the written sound to the cache."""
+        self._file.close()
+        os.replace(self._temp, self.cache._path(self.key))
+        self.cache.evict()
+
+    def discard(self):
+        """Throw the written sound away."""
+        self._file.close()
+        try:
+            os.remove(self._temp)
+        except OSError:
+            pass
@@ -24,9 +24,9 @@ Command-line parsing
 
 import sys
 from optparse import OptionParser, OptionGroup
-import os
-import re
 from . import core
+from . import batch
+from . import image
 from . import misc
 from . import info
 
@@ -48,10 +48,10 @@ class _SimplerOptionParser(OptionParser):
 
 def parse_args(cmdargs=None):
     """
-    parse_args(cmdargs: [str] = sys.argv[1:]) -> SoundCore
+    parse_args(cmdargs: [str] = sys.argv[1:]) -> SoundCore or Batch
 
     Base actions on input from the command line. Create a SoundCore object from
-    the given options.
+    the given options, or a batch.Batch with --batch.
     """
 
     if cmdargs is None:
@@ -65,7 +65,9 @@ def parse_args(cmdargs=None):
         epilog='''
 Input images must be in a format supported by pygame, i.e. either PNG, JPEG,
 GIF, BMP, TGA, PCX, TIF, LBM, PMB, PGM, PPM, or XPM (or a subset). There is
-also limited support for OpenRaster files.
+also limited support for OpenRaster files. Very large images can be converted
+to pumila's raw format with pumila-convert, which is read from disk only as
+the sound is generated.
 
 If you specify more than one input file, the generated sounds from each file
 will be mixed. Extra options, such as gain, can be given as comma-seperated
@@ -73,7 +75,10 @@ KEY=VALUE pairs after a slash after the filename, like
 `testdir/test1.png/gain=0.7,min=300 Hz,max=10 kHz'. `gain' must be a number
 between 0 and 1, and defaults to 1. `min' and `max' denotes the lowest and
 highest frequency and understand units. `min' defaults to 220 Hz, and `max'
-defaults to 2200 Hz.
+defaults to 2200 Hz. `pan' moves the sound from the first (-1) to the last (1)
+channel, and `channels' restricts it to some channels, like `channels=0+2'.
+Both default to all channels getting the full sound and do not work with the
+python engine.
 
 ''')
 
@@ -94,11 +99,12 @@ do not output sound to a file.
 ''')
 
     parser.add_option('-f', '--output-format', dest='outputformat',
-                      metavar='FILEFORMAT', type='choice', choices=['wav'],
+                      metavar='FILEFORMAT', type='choice', choices=['wav', 'pcm'],
                       help='''
 
 the format of the sound output. Choose between the default WAVE format 'wav'
-(playable by all audio players) and nothing else.
+(playable by all audio players) and 'pcm', the bare samples in the sample
+format without any header.
 
 ''')
         
@@ -119,8 +125,18 @@ play the sound after it has been generated.
     parser.add_option('-P', '--play-at-once', dest='playatonce',
                       action='store_true', help='''
 
-play the sound while it is being generated. This will most likely result in
-poor audio, if any, unless your computer is very fast.
+play the sound while it is being generated. Playback starts when enough sound
+has been generated to not run out, judging by how fast the first part was
+generated. Underruns are logged.
+
+''', default=False)
+
+    parser.add_option('-s', '--stream', dest='stream',
+                      action='store_true', help='''
+
+keep memory use independent of the width of the images: analyse them a strip
+of columns at a time, and play the sound block by block while it is being
+generated. Reports the peak memory use.
 
 ''', default=False)
 
@@ -150,9 +166,19 @@ the number of channels. Defaults to 1 (mono).
     parser.add_option('-w', '--sample-width', dest='samplewidth',
                       metavar='BITS', type='int', help='''
 
-the size of a sample. Not applicable with the .pml format. Defaults to 16 bits.
+the size of a sample: 8, 16, 24 or 32 bits. Not applicable with the .pml
+format. Defaults to 16 bits.
 
 ''', default=16)
+
+    parser.add_option('-W', '--sample-format', dest='sampleformat',
+                      metavar='FORMAT', type='choice',
+                      choices=sorted(core.sample_formats), help='''
+
+the format of a sample: 'u8', 's16', 's24', 's32' or 'f32' (32-bit float).
+Overrides --sample-width.
+
+''')
     
     parser.add_option('-r', '--framerate', dest='framerate',
                       metavar='INTEGER', type='int', help='''
@@ -161,6 +187,160 @@ the number of samples in one second. Defaults to 44100 (Hz).
 
 ''', default=44100)
 
+    parser.add_option('-e', '--engine', dest='engine',
+                      metavar='ENGINE', type='choice', choices=core.engines,
+                      help='''
+
+the sound generator to use. Choose between the slow reference generator
+'python' (the default), 'numpy', which computes a whole pixel column at a time
+and is many times faster, 'wavetable', which is like 'numpy' but looks
+waves up in precomputed tables, and 'fft', which synthesizes every column in
+the frequency domain and wins on images with many audible rows of reddish
+(sine) pixels, and more so with long pixel durations. Its sound fades smoothly
+from column to column.
+
+''', default='python')
+
+    parser.add_option('--image-backend', dest='imagebackend',
+                      metavar='BACKEND', type='choice',
+                      choices=image.backends, help='''
+
+the image decoder to use. Choose between 'pillow', 'pygame' and 'png', a
+built-in decoder of PNG images which needs neither Pillow nor PyGame. Defaults
+to Pillow if available, and otherwise to 'png' for PNG images and PyGame for
+other images.
+
+''')
+
+    parser.add_option('--phase-reset', dest='phasereset',
+                      action='store_true', help='''
+
+start the waves of every column at phase 0, so that the sound of identical
+columns can always be reused. Does not work with the python engine.
+
+''', default=False)
+
+    parser.add_option('--normalize', dest='normalization',
+                      metavar='MODE', type='choice',
+                      choices=core.normalizations, help='''
+
+how to keep the sum of the pixels of a column between -1 and 1. Choose between
+'count' (the default), which divides every column by its number of audible
+pixels, 'none', 'peak', which scales the whole sound so that its highest
+possible peak reaches the level of --norm-level (0 dBFS by default), 'rms',
+which scales it so that its estimated RMS level reaches that level (-20 dBFS
+by default) and softly limits what would go above 0 dBFS, and 'limit', which
+softly limits the samples to that level (-1 dBFS by default). Only 'count'
+works with the python engine.
+
+''', default='count')
+
+    parser.add_option('--norm-level', dest='normlevel',
+                      metavar='DBFS', type='float', help='''
+
+the target level of the peak and rms normalizations, or the ceiling of the
+limit normalization, in dBFS.
+
+''')
+
+    parser.add_option('--ramp', dest='ramp', metavar='MILLISECONDS',
+                      help='''
+
+fade from every pixel column to the next one during the first MILLISECONDS of
+the next one (at most a whole column), so that the sound does not click at the
+column edges. Only works with the numpy and wavetable engines; the fft engine
+always fades.
+
+''')
+
+    parser.add_option('--ramp-shape', dest='rampshape', metavar='SHAPE',
+                      type='choice', choices=core.ramp_shapes, help='''
+
+the shape of the fades of --ramp: 'cosine' (a raised cosine, the default) or
+'linear'.
+
+''', default='cosine')
+
+    parser.add_option('--band-limit', dest='bandlimited',
+                      action='store_true', help='''
+
+make the triangle, square and sawtooth waves band-limited, so that high
+frequencies do not alias into lower ones and need no oversampling. The numpy
+engine rounds their edges off (PolyBLEP), and the wavetable engine uses tables
+with fewer harmonics for higher octaves. The fft engine is always
+band-limited, and the python engine cannot be.
+
+''', default=False)
+
+    parser.add_option('-j', '--jobs', dest='workers',
+                      metavar='INTEGER', type='int', help='''
+
+the number of processes to render with. Does not work with the python engine.
+Defaults to 1. With --batch, the number of jobs to render at a time,
+defaulting to the number of CPUs.
+
+''')
+
+    parser.add_option('--batch', dest='batch',
+                      metavar='MANIFEST', help='''
+
+render every job listed in the file MANIFEST ('-' means standard in) instead
+of the input files, all with the other options given. Each line of it is the
+output file and then its input files with their settings, separated by tabs.
+Empty lines and lines starting with '#' are skipped. The jobs are rendered by
+a pool of processes, and the time each took is logged along with a summary.
+
+''')
+
+    parser.add_option('-b', '--block-size', dest='blocksize',
+                      metavar='FRAMES', type='int', help='''
+
+the number of frames to convert and write at a time. Defaults to 4096.
+
+''', default=4096)
+
+    parser.add_option('--cache-dir', dest='cachedir',
+                      metavar='DIRECTORY', help='''
+
+where to keep generated sounds for reuse. Defaults to ~/.pumila/cache.
+
+''')
+
+    parser.add_option('--cache-size', dest='cachesize',
+                      metavar='MEBIBYTES', type='int', help='''
+
+how large the cache may grow before the least recently used sounds are
+deleted. Defaults to 1024 MiB.
+
+''', default=1024)
+
+    parser.add_option('--no-cache', dest='cache',
+                      action='store_false', help='''
+
+do not reuse or store generated sounds.
+
+''', default=True)
+
+    parser.add_option('--stats', dest='stats',
+                      metavar='FORMAT', type='choice', choices=['json'],
+                      help='''
+
+measure the time spent in each stage of the render (loading, synthesis,
+writing, ...) and count the work done (samples, bytes written, cache hits,
+...), and print it to standard error when done. Only 'json' is accepted as
+FORMAT. Cannot be used with --batch.
+
+''')
+
+    parser.add_option('--profile', dest='profile',
+                      metavar='FILENAME', help='''
+
+profile the render with cProfile and save the result to FILENAME, to be read
+with the pstats module. The memory allocations are traced as well and saved
+to FILENAME.tracemalloc. Cannot be used with --batch.
+
+''')
+
     parser.add_option('-q', '--quiet', dest='verbose',
                       action='store_false', help='''
 
@@ -188,26 +368,54 @@ and "description". This option currently does nothing.
 
     o, args = parser.parse_args(cmdargs)
         
-    o.inputfiles = []
-    for x in args:
-        if os.path.exists(x):
-            o.inputfiles.append(x)
-        elif '/' in x:
-            path, settings = x.rsplit('/', 1)
-            settings = {k: v for k, v in (re.split('\s*=\s*', x)
-                                          for x in settings.split(','))}
-            o.inputfiles.append((path, settings))
-            
+    o.inputfiles = [x for x in map(batch.parse_inputspec, args)
+                    if x is not None]
+
+    if o.batch:
+        if o.inputfiles:
+            parser.error('input files cannot be given with --batch')
+        if o.stats or o.profile:
+            parser.error('--stats and --profile cannot be given with --batch')
+        if o.batch == '-':
+            jobs = batch.read_manifest(sys.stdin)
+        else:
+            with open(o.batch) as f:
+                jobs = batch.read_manifest(f)
+        return batch.Batch(
+            jobs, processes=o.workers, verbose=o.verbose, channels=o.channels,
+            samplewidth=o.samplewidth, sampleformat=o.sampleformat,
+            framerate=o.framerate, pixelduration=o.pixelduration,
+            fullduration=o.fullduration, play=o.play,
+            playatonce=o.playatonce, outputformat=o.outputformat,
+            overwrite=o.overwrite, metadata=o.metadata, engine=o.engine,
+            blocksize=o.blocksize, stream=o.stream, cache=o.cache,
+            cachedir=o.cachedir, cachesize=o.cachesize * 2 ** 20,
+            phasereset=o.phasereset, imagebackend=o.imagebackend,
+            normalization=o.normalization, normlevel=o.normlevel,
+            ramp=o.ramp, rampshape=o.rampshape, bandlimited=o.bandlimited)
+
     if not o.inputfiles:
         parser.print_help()
         print()
         parser.error('no input file specified')
 
     return core.SoundCore(*o.inputfiles, channels=o.channels,
-                           samplewidth=o.samplewidth, framerate=o.framerate,
+                           samplewidth=o.samplewidth,
+                           sampleformat=o.sampleformat, framerate=o.framerate,
                            pixelduration=o.pixelduration,
                            fullduration=o.fullduration, play=o.play,
                            playatonce=o.playatonce, outputfile=o.outputfile,
                            outputformat=o.outputformat, overwrite=o.overwrite,
                            metadata=o.metadata, verbose=o.verbose,
-                           showprogressbar=o.showprogressbar)
+                           showprogressbar=o.showprogressbar, engine=o.engine,
+                           workers=o.workers or 1, blocksize=o.blocksize,
+                           stream=o.stream, cache=o.cache,
+                           cachedir=o.cachedir, cachesize=o.cachesize * 2 ** 20,
+                           phasereset=o.phasereset,
+                           imagebackend=o.imagebackend,
+                           normalization=o.normalization,
+                           normlevel=o.normlevel, ramp=o.ramp,
+                           rampshape=o.rampshape,
+                           bandlimited=o.bandlimited,
+                           statsfile=sys.stderr if o.stats else None,
+                           profile=o.profile)
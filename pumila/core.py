@@ -28,37 +28,197 @@ from fractions import Fraction
 import itertools
 import re
 import numpy
-import pygame
 import colorsys
 import time
 import collections
 import math
 import wave
+import struct
+import asyncio
+import json
+try:
+    import resource
+except ImportError:
+    resource = None
 try:
     import progressbar
 except ImportError:
     progressbar = None
 
-from .generate import SoundGenerator
+from .generate import SoundGenerator, engines, engines_version, to_bytes, \
+    sample_formats, normalizations, normalization_levels, ramp_shapes, \
+    ramp_envelope
 from . import units
 from . import image
 from . import primitives
 from . import misc
 from . import info
+from . import profiling
+from .cache import RenderCache
 
 _selfdict, log = misc.get_selfdict(__name__), misc.newlog('core')
 info.add_metadata(_selfdict)
 
+# The attributes that, together with the images, decide the generated sound
+_cache_params = ('engine', 'framerate', 'channels', 'sampleformat',
+                 'one_pixel_samples_len', 't_samples_len', 'phasereset',
+                 'normalization', 'normlevel', 'ramp_samples', 'rampshape',
+                 'bandlimited')
+
+# row_frequencies results by arguments. They are kept for as long as the
+# process lives, so that the renders of a batch share them.
+_row_frequencies = {}
+_row_frequencies_max = 256
+
+def row_frequencies(low, high, height):
+    """
+    row_frequencies(low: number, high: number, height: int)
+        -> ((float,), ((float,),))
+
+    Get the frequencies of the rows of an image height pixels high whose
+    bottom row has the frequency low and top row almost high, and the wave
+    lengths of each frequency (see primitives.getlengths).
+    """
+    key = (low, high, height)
+    try:
+        return _row_frequencies[key]
+    except KeyError:
+        pass
+    ratio = (high - low) / height
+    freqs = tuple(float(ratio * r + low) for r in reversed(range(height)))
+    result = (freqs, tuple(primitives.getlengths(freq) for freq in freqs))
+    if len(_row_frequencies) >= _row_frequencies_max:
+        _row_frequencies.clear()
+    _row_frequencies[key] = result
+    return result
+
+class _FloatWaveWrite:
+    """
+    Write 32-bit IEEE float WAVE files, which the wave module cannot. Has the
+    parts of the wave.Wave_write interface that SoundCore uses.
+    """
+
+    def __init__(self, f, channels, framerate, nframes):
+        if isinstance(f, str):
+            f = open(f, 'wb')
+            self._close = True
+        else:
+            self._close = False
+        self._file, self._channels, self._framerate = f, channels, framerate
+        self._written = 0
+        self._header_pos = None
+        try:
+            self._header_pos = f.tell()
+        except (AttributeError, OSError):
+            pass
+        self._write_header(nframes * channels * 4)
+
+    def _write_header(self, datalen):
+        blockalign = self._channels * 4
+        fmt = struct.pack('<HHIIHHH', 3, self._channels, self._framerate,
+                          self._framerate * blockalign, blockalign, 32, 0)
+        self._file.write(
+            b'RIFF' + struct.pack('<I', 50 + datalen) + b'WAVE' +
+            b'fmt ' + struct.pack('<I', len(fmt)) + fmt +
+            b'fact' + struct.pack('<II', 4, datalen // blockalign) +
+            b'data' + struct.pack('<I', datalen))
+        self._datalen = datalen
+
+    def writeframesraw(self, data):
+        self._file.write(data)
+        self._written += len(data)
+
+    def close(self):
+        if self._written != self._datalen and self._header_pos is not None:
+            self._file.seek(self._header_pos)
+            self._write_header(self._written)
+            self._file.seek(0, 2)
+        self._file.flush()
+        if self._close:
+            self._file.close()
+
+class _RawWrite:
+    """
+    Write bare samples without any header. Has the parts of the
+    wave.Wave_write interface that SoundCore uses.
+    """
+
+    def __init__(self, f):
+        if isinstance(f, str):
+            f = open(f, 'wb')
+            self._close = True
+        else:
+            self._close = False
+        self._file = f
+
+    def writeframesraw(self, data):
+        self._file.write(data)
+
+    def close(self):
+        self._file.flush()
+        if self._close:
+            self._file.close()
+
 class SoundCore(SoundGenerator):
     def __init__(self, *inputfiles, channels=1, samplewidth=16, framerate=44100,
                  pixelduration=None, fullduration=None, play=False,
                  playatonce=False, outputfile=None, outputformat=None,
                  overwrite=False, metadata={}, returndata=None, verbose=False,
-                 showprogressbar=False):
+                 showprogressbar=False, engine='python', workers=1,
+                 blocksize=4096, sampleformat=None, stream=False,
+                 cache=True, cachedir=None, cachesize=2 ** 30,
+                 phasereset=False, imagebackend=None, loader=None,
+                 stats=False, statsfile=None, profile=None,
+                 normalization='count', normlevel=None, ramp=None,
+                 rampshape='cosine', bandlimited=False):
         """
         Generate sound waves.
 
-        If returndata, return a list of numbers.
+        If returndata, return a list of numbers (stream and astream give the
+        sound in blocks of samples instead). engine is one of 'python' (the
+        reference generator), 'numpy', 'wavetable' and 'fft' (all much faster,
+        see generate.engines). All but the python engine can split the
+        rendering between several worker processes; the result is the same.
+        Samples are written to the outputs in blocks of blocksize frames.
+
+        sampleformat is one of 'u8', 's16', 's24', 's32' and 'f32' (IEEE
+        float); if not given, it is the integer format of samplewidth bits.
+
+        If stream, keep memory use independent of the image width: analyse the
+        images a strip of columns at a time, and play the sound block by block
+        while it is generated instead of from a buffer of the whole sound.
+
+        imagebackend is the image decoder, one of image.backends; by default
+        the first one available that decodes the image. pygame is only
+        imported to play sound or decode images with it. Images are loaded
+        with loader(path, backend), by default image.load.
+
+        outputfile is a path, '-' for standard out, or a file object. The
+        outputformat 'pcm' writes the samples without any header.
+
+        normalization is one of generate.normalizations: 'count' (the
+        default, and the only one of the python engine), 'none', 'peak',
+        'rms' and 'limit'. normlevel is the target in dBFS of 'peak' and
+        'rms' and the ceiling of 'limit', by default the one in
+        generate.normalization_levels.
+
+        If ramp, a duration (in ms by default), the numpy and wavetable
+        engines fade from the weights of every column to those of the next
+        one during the first ramp of the next one (at most a whole column),
+        so that the sound does not click at the column edges. rampshape is
+        'cosine' (a raised cosine, the default) or 'linear'. The fft engine
+        always fades from column to column.
+
+        If bandlimited, the numpy and wavetable engines make the triangle,
+        square and sawtooth waves with little aliasing, so that they need no
+        oversampling (see generate.engines). The sound of the fft engine is
+        always band-limited.
+
+        If stats, measure the time spent in and the work done by each stage
+        of the render (see the stats attribute); if statsfile, a path or file
+        object, also write them there as JSON after run. If profile, a path,
+        save a cProfile profile of run there and its memory allocations next
+        to it (see profiling.Profile).
         """
         self.inputfiles = []
         for path in inputfiles:
@@ -82,10 +242,66 @@ class SoundCore(SoundGenerator):
         self.channels, self.samplewidth, self.framerate, self.pixelduration, \
             self.fullduration, self.play, self.playatonce, self.outputfile, \
             self.outputformat, self.overwrite, self.metadata, self.returndata, \
-            self.verbose, self.showprogressbar = \
+            self.verbose, self.showprogressbar, self.engine, self.workers, \
+            self.blocksize, self.streaming, self.phasereset, \
+            self.imagebackend, self.loader, self.normalization = \
             channels, samplewidth, framerate, pixelduration, fullduration, \
             play, playatonce, outputfile, outputformat, overwrite, metadata, \
-            returndata, verbose, showprogressbar
+            returndata, verbose, showprogressbar, engine, workers, blocksize, \
+            stream, phasereset, imagebackend, loader or image.load, \
+            normalization
+
+        if self.engine not in engines:
+            raise ValueError('{} is not an accepted engine'.format(
+                    repr(self.engine)))
+        if self.workers > 1 and self.engine == 'python':
+            raise ValueError('the python engine cannot use several workers')
+        if self.phasereset and self.engine == 'python':
+            raise ValueError('the python engine cannot reset phases')
+        if self.blocksize < 1:
+            raise ValueError('the block size must be at least 1 frame')
+        if self.normalization not in normalizations:
+            raise ValueError('{} is not an accepted normalization'.format(
+                    repr(self.normalization)))
+        if self.normalization != 'count' and self.engine == 'python':
+            raise ValueError('the python engine only normalizes by count')
+        if normlevel is not None and \
+                self.normalization not in normalization_levels:
+            raise ValueError('the {} normalization takes no level'.format(
+                    self.normalization))
+        self.normlevel = float(normalization_levels.get(
+                self.normalization, 0) if normlevel is None else normlevel)
+        self.norm_gain, self.norm_limit = 1.0, None
+        self.ramp = self._unit_parse(ramp, 'ms') if ramp else None
+        if ramp and (self.ramp is None or self.ramp < 0):
+            raise ValueError('{} is not an accepted ramp'.format(repr(ramp)))
+        self.rampshape = rampshape
+        if self.ramp and self.engine not in ('numpy', 'wavetable'):
+            raise ValueError('the {} engine cannot ramp'.format(self.engine))
+        if self.rampshape not in ramp_shapes:
+            raise ValueError('{} is not an accepted ramp shape'.format(
+                    repr(self.rampshape)))
+        self.ramp_envelope = None
+        self.bandlimited = bandlimited
+        if self.bandlimited and self.engine == 'python':
+            raise ValueError('the python engine cannot band-limit')
+        if self.imagebackend is not None:
+            image.available_backend(self.imagebackend)
+        if sampleformat is None:
+            sampleformat = {8: 'u8', 16: 's16', 24: 's24', 32: 's32'}.get(
+                samplewidth)
+            if sampleformat is None:
+                raise ValueError('{} is not an accepted sample width'.format(
+                        samplewidth))
+        elif sampleformat not in sample_formats:
+            raise ValueError('{} is not an accepted sample format'.format(
+                    repr(sampleformat)))
+        self.sampleformat = sampleformat
+        self.samplewidth = sample_formats[sampleformat][0]
+        if self.engine == 'python' and any(
+            'pan' in sett or 'channels' in sett
+            for path, sett in self.inputfiles):
+            raise ValueError('the python engine does not support pan or channels')
 
         if self.playatonce:
             self.play = True
@@ -94,14 +310,17 @@ class SoundCore(SoundGenerator):
         elif outputfile:
             if outputformat:
                 self.outputformat = outputformat.lower()
-            elif outputfile.lower().endswith('.pml'):
+            elif isinstance(outputfile, str) and \
+                    outputfile.lower().endswith('.pml'):
                 self.outputformat = 'pml'
             else:
                 self.outputformat = 'wav' # Default
-            if self.outputformat not in ('pml', 'wav'):
+            if self.outputformat not in ('pml', 'wav', 'pcm'):
                 raise ValueError('{} is not an accepted format'.format(
                         self.outputformat))
-            if outputfile == '-':
+            if not isinstance(outputfile, str):
+                pass # A file object
+            elif outputfile == '-':
                 self.outputfile = open(1, 'wb')
             elif os.path.isfile(outputfile) and not overwrite:
                 raise ValueError('file {} already exists'.format(
@@ -113,6 +332,15 @@ class SoundCore(SoundGenerator):
             self.fullduration = self._unit_parse(self.fullduration, 'ms')
         elif not self.pixelduration:
             self.pixelduration = 10 # ms, default
+        # The durations asked for; prepare sets pixelduration and fullduration
+        # to the ones the sound really has
+        self._durations = (self.pixelduration, self.fullduration)
+
+        self.cache = RenderCache(cachedir, cachesize) if cache else None
+        self.cache_entry = None
+        self.wavof = None
+        self.statsfile, self.profile = statsfile, profile
+        self.instruments = profiling.Stats(bool(stats or statsfile))
 
         self.log = log if self.verbose else misc.donothing
         if not self.verbose or not progressbar:
@@ -122,20 +350,50 @@ class SoundCore(SoundGenerator):
         """
         parse_settings(settings: dict) -> dict
 
-        Remove pairs where key is not in ('gain', 'min', 'max') and parse units.
+        Remove pairs where key is not in ('gain', 'min', 'max', 'pan',
+        'channels') and parse units. 'pan' is a number from -1 (first channel)
+        to 1 (last channel), and 'channels' is a list of channel numbers
+        (counting from 0) separated by '+'.
         """
         # Warning: a new dict is not created
-        for k, v in settings.items():
-            if k not in ('gain', 'min', 'max'):
-                del settings[k]
-            elif k in ('gain', 'min', 'max'):
+        for k, v in list(settings.items()):
+            if k in ('gain', 'min', 'max', 'pan'):
                 val = self._unit_parse(v, 'Hz')
                 if val:
                     settings[k] = val
                 else:
                     del settings[k]
+            elif k == 'channels' and isinstance(v, str):
+                try:
+                    settings[k] = tuple(int(x) for x in v.split('+'))
+                except ValueError:
+                    del settings[k]
+            elif k != 'channels':
+                del settings[k]
         return settings
 
+    def get_channel_gains(self, settings):
+        """
+        get_channel_gains(settings: dict) -> array
+
+        Get the gain of every output channel for an image with the given
+        settings. Without 'pan' and 'channels', every channel gets the full
+        sound. Panning towards one side attenuates the channels on the other
+        side linearly, so that the outermost channel is silent at full pan.
+        """
+        gains = numpy.ones(self.channels)
+        if 'pan' in settings and self.channels > 1:
+            pos = numpy.linspace(-1, 1, self.channels)
+            gains = numpy.clip(1 + float(settings['pan']) * pos, 0, 1)
+        if 'channels' in settings:
+            mask = numpy.zeros(self.channels)
+            for c in settings['channels']:
+                if not 0 <= c < self.channels:
+                    raise ValueError('there is no channel {}'.format(c))
+                mask[c] = 1
+            gains *= mask
+        return gains
+
     def _unit_parse(self, val, default_unit=None):
         try:
             return Fraction(val)
@@ -152,20 +410,52 @@ class SoundCore(SoundGenerator):
                 else:
                     return wn
 
-    def run(self):
-        """Generate the sound waves."""
+    def load(self):
+        """
+        Load the input images and precompute their pixel tables. Does nothing
+        if they have already been loaded, so that several renders of the same
+        images (with e.g. different durations or framerates) share the work.
+        """
+        if hasattr(self, 'indata'):
+            return
         self.log('Loading images...')
         self.indata = []
         for path, sett in self.inputfiles:
-            loaded = image.load(path)
+            with self.instruments.timer('decode'):
+                loaded = self.loader(path, self.imagebackend)
             if isinstance(loaded[0], tuple):
                 for img in loaded:
                     self.indata.append((img, sett))
             else:
                 self.indata.append((loaded, sett))
         self.log('Loaded {} images.'.format(len(self.indata)))
+        self.instruments.count('images', len(self.indata))
+        self.instruments.count('pixels', sum(
+                img[1].size for img, sett in self.indata))
+        if self.engine != 'python':
+            with self.instruments.timer('analyse'):
+                self.tables = tuple(
+                    image.PixelTable(*img, strips=self.streaming)
+                    for img, sett in self.indata)
+
+    def prepare(self):
+        """
+        Load the images and work out the durations, gains and frequencies of
+        the sound without generating any of it. Called by run and stream; does
+        nothing if it has already been done, so that errors in the settings
+        can be caught before the sound is wanted.
+        """
+        if getattr(self, '_prepared', False):
+            return
+        self.load()
+        with self.instruments.timer('setup'):
+            self._prepare()
+        self._prepared = True
+
+    def _prepare(self):
 
         maxlen = max(len(x[0][1]) for x in self.indata)
+        self.pixelduration, self.fullduration = self._durations
         if not self.pixelduration:
             self.pixelduration = Fraction(self.fullduration, maxlen)
         elif not self.fullduration:
@@ -183,7 +473,7 @@ class SoundCore(SoundGenerator):
                 self.one_pixel_samples_len, self.t_samples_len))
 
         self.pixelduration = Fraction(1000 * self.one_pixel_samples_len,
-                                      self.framerate * self.channels)
+                                      self.framerate)
         self.fullduration = Fraction(1000 * self.samples_len,
                                      self.framerate * self.channels)
         self.log('Pixel duration is {} ms, full duration is {} ms.'.format(
@@ -196,72 +486,328 @@ class SoundCore(SoundGenerator):
         self.rgbs = tuple(x[0] for x in data)
         self.alphas = tuple(x[1] for x in data)
         self.gains = tuple(float(x['gain']) for x in settings)
+        self.channel_gains = tuple(self.get_channel_gains(x) for x in settings)
         self.imgs_range = tuple(range(len(settings)))
 
         self.waves = {}
         self.freq_range = []
+        self.freq_lengths = []
         i = 0
         for x in settings:
-            row_height = len(self.alphas[i][0])
-            diff = x['max'] - x['min']
-            ratio = diff / row_height
-            freqs = tuple(float(ratio * r + x['min']) for r in reversed(
-                    range(row_height)))
+            freqs, lengths = row_frequencies(x['min'], x['max'],
+                                             len(self.alphas[i][0]))
             self.freq_range.append(freqs)
-            for freq in freqs:
-                self.waves[freq] = primitives.getlengths(freq)
+            self.waves.update(zip(freqs, lengths))
+            self.freq_lengths.append(lengths)
             i += 1
+        if self.engine != 'python':
+            self.freq_range = [numpy.array(x) for x in self.freq_range]
+            self.freq_lengths = [numpy.array(x) for x in self.freq_lengths]
+            # One oscillator for every distinct frequency of all images, so
+            # that images and layers sharing frequencies share oscillators
+            self.oscillators, inverse = numpy.unique(
+                numpy.concatenate(self.freq_range), return_inverse=True)
+            bounds = numpy.cumsum([0] + [len(x) for x in self.freq_range])
+            self.row_oscillators = tuple(inverse[a:b] for a, b in
+                                         zip(bounds[:-1], bounds[1:]))
+            self.oscillator_lengths = numpy.concatenate(self.freq_lengths)[
+                numpy.unique(inverse, return_index=True)[1]]
+            self.instruments.count('oscillators', len(self.oscillators))
+        if self.engine == 'wavetable':
+            self.bank = primitives.WavetableBank(self.oscillators,
+                                                 self.framerate,
+                                                 self.bandlimited)
+        if self.engine == 'fft':
+            self.spectral_bank = primitives.SpectralBank(
+                self.oscillators, self.framerate, self.one_pixel_samples_len)
+        if self.engine != 'python':
+            # The largest absolute value of every wave of every oscillator
+            self.wave_peaks = self.bank.peaks if self.engine == 'wavetable' \
+                else self.spectral_bank.peaks if self.engine == 'fft' \
+                else numpy.ones((len(primitives.wave_arrays),
+                                 len(self.oscillators)))
 
+        self.ramp_samples = min(int(self.ramp * self.framerate / 1000),
+                                self.one_pixel_samples_len) \
+                                if self.ramp else 0
+        if self.ramp_samples:
+            self.ramp_envelope = ramp_envelope(self.rampshape,
+                                               self.ramp_samples)
+
+        level = 10 ** (self.normlevel / 20)
+        if self.normalization == 'limit':
+            self.norm_limit = level
+        elif self.normalization in ('peak', 'rms'):
+            peak, power = self.column_levels()
+            top = peak.max() if self.normalization == 'peak' else \
+                math.sqrt(power.mean(axis=0).max())
+            self.norm_gain = level / top if top > 0 else 1.0
+            self.log('Normalizing the {} to {} dBFS with a gain of {:.1f} '
+                     'dB.'.format(self.normalization, self.normlevel,
+                                  20 * math.log10(self.norm_gain)))
+            if peak.max() * self.norm_gain > 1:
+                # Rather than clip the loudest parts, limit them
+                self.norm_limit = 1.0
+                self.log('The sound may peak above 0 dBFS, so it is limited.')
+
+    def column_levels(self):
+        """
+        column_levels() -> (array, array)
+
+        Get an upper bound of the amplitude and an estimate of the mean
+        square of the sound of every column and channel, as arrays of shape
+        (columns, channels), from the pixel tables, before normalization. The
+        bound allows for the overshoot of band-limited waves (see
+        wave_peaks). The mean square is exact if no two pixels of a column
+        share a frequency.
+        """
+        width = max(table.width for table in self.tables)
+        peak = numpy.zeros((width, self.channels))
+        power = numpy.zeros((width, self.channels))
+        squares = numpy.array(primitives.mean_squares)
+        products = numpy.array(primitives.mean_products)
+        peaks = self.wave_peaks
+        for table, gain, channel_gains, oscs in zip(
+            self.tables, self.gains, self.channel_gains,
+            self.row_oscillators):
+            sums = table.column_sums(lambda rows, amp, wa, wb, pair: numpy.stack(
+                    (amp * (wa * peaks[pair, oscs[rows]] +
+                            wb * peaks[(pair + 1) % 4, oscs[rows]]),
+                     amp ** 2 * (wa ** 2 * squares[pair] +
+                                 wb ** 2 * squares[(pair + 1) % 4] +
+                                 2 * wa * wb * products[pair])), axis=1))
+            g = gain * channel_gains
+            peak[:table.width] += sums[:, 0, None] * g
+            power[:table.width] += sums[:, 1, None] * g ** 2
+        return peak, power
+
+    def run(self):
+        """Generate the sound waves."""
+        if self.profile is not None:
+            profile = profiling.Profile(self.profile)
+            profile.start()
+        try:
+            with self.instruments.timer('run'):
+                result = self._run()
+        finally:
+            if self.profile is not None:
+                peak = profile.stop()
+                self.instruments.count('traced_peak_bytes', peak)
+                self.log('Saved the profile to {}.'.format(self.profile))
+        if self.statsfile is not None:
+            self.write_stats(self.statsfile)
+        return result
+
+    def _run(self):
+        self.prepare()
         if self.returndata:
             return self.get_samples()
-        if self.outputformat == 'wav':
-            self.wavof = wave.open(self.outputfile, 'w')
-            self.wavof.setnchannels(self.channels)
-            self.wavof.setsampwidth(self.samplewidth // 8)
-            self.wavof.setframerate(self.framerate)
+        cached = None
+        if self.cache is not None:
+            with self.instruments.timer('cache_key'):
+                self.cache_key = self.cache.key(self.indata, (
+                        info.program.version.text, engines_version) + tuple(
+                        getattr(self, x) for x in _cache_params))
+            cached = self.cache.open(self.cache_key)
+            self.instruments.count('cache_misses' if cached is None
+                                   else 'cache_hits')
+        if self.outputformat == 'pcm':
+            self.wavof = _RawWrite(self.outputfile)
+        elif self.outputformat == 'wav':
+            if sample_formats[self.sampleformat][1]:
+                self.wavof = _FloatWaveWrite(self.outputfile, self.channels,
+                                             self.framerate, self.t_samples_len)
+            else:
+                self.wavof = wave.open(self.outputfile, 'w')
+                self.wavof.setnchannels(self.channels)
+                self.wavof.setsampwidth(self.samplewidth // 8)
+                self.wavof.setframerate(self.framerate)
+                self.wavof.setnframes(self.t_samples_len)
 
         if self.play:
+            import pygame
             pygame.mixer.init(self.framerate, -16, self.channels, 1024)
-            self.sound_offset = int(self.channels * self.framerate / 5) \
-                if self.playatonce else 0
-            soundarr = numpy.empty(self.samples_len + self.sound_offset,
+        if self.playatonce:
+            from . import realtime
+            self.player = realtime.Player(
+                pygame.mixer.Channel(0), self.framerate, self.channels,
+                self.t_samples_len, log=self.log)
+        elif self.play and self.streaming:
+            self.mixer_channel = pygame.mixer.Channel(0)
+            self.log('Starting playback...')
+        elif self.play:
+            soundarr = numpy.empty(self.t_samples_len if self.channels == 1
+                                   else (self.t_samples_len, self.channels),
                                    dtype=numpy.int16)
             sound = pygame.sndarray.make_sound(soundarr)
-            self.soundarr = pygame.sndarray.samples(sound)
-            if self.playatonce:
-                self.log('Starting playback...')
-                sound.play()
-                play_start = time.time()
-
-        self.log('Generating sound...')
-        gen_start = time.time()
+            self.soundarr = pygame.sndarray.samples(sound).reshape(-1)
+
         if self.showprogressbar:
             self.pbar = progressbar.ProgressBar(maxval=self.samples_len).start()
-             # few have a terminal with a width above 300
-            self.pbar_interval = self.samples_len // 300
-        self.generate()
+        if cached is not None:
+            self.log('Using the cached sound {}.'.format(self.cache_key))
+            with cached:
+                self.replay(cached)
+        else:
+            self.log('Generating sound...')
+            gen_start = time.time()
+            if self.cache is not None:
+                self.cache_entry = self.cache.writer(self.cache_key)
+            try:
+                self.generate()
+            except BaseException:
+                if self.cache_entry is not None:
+                    self.cache_entry.discard()
+                raise
+            if self.cache_entry is not None:
+                self.cache_entry.commit()
+            gen_diff = time.time() - gen_start
+            self.log('Sound has been generated. The process took {:.1f} seconds{}.'.format(
+                    gen_diff, " (that's more than {} minutes!)".format(int(gen_diff // 60))
+                    if gen_diff / 60 > 3 else ''))
+            if self.engine != 'python':
+                self._count_columns()
+                columns, silent, reused, audible = self.column_counts
+                self.log('{} of {} columns were silent, and {} were reused '
+                         '({:.0%} of all columns).'.format(
+                        silent, columns, reused,
+                        (silent + reused) / columns if columns else 0))
         if self.showprogressbar:
             self.pbar.finish()
-        gen_diff = time.time() - gen_start
-        self.log('Sound has been generated. The process took {:.1f} seconds{}.'.format(
-                gen_diff, " (that's more than {} minutes!)".format(int(gen_diff // 60))
-                if gen_diff / 60 > 3 else ''))
 
-        if self.play:
-            if self.playatonce:
-                diff = time.time() - play_start
-                wait = math.ceil(self.fullduration - diff * 1000 +
-                                 1000 * self.sound_offset / self.framerate)
-            else:
-                self.log('Starting playback...')
-                sound.play()
-                wait = math.ceil(self.fullduration)
-            pygame.time.wait(wait)
+        if self.playatonce:
+            self.player.close()
+            self.instruments.count('underruns', self.player.underruns)
+            self.log('Played with a latency of {:.0f} ms and {} underruns. '
+                     'The smallest render-ahead margin was {:.0f} ms.'.format(
+                    1000 * self.player.latency, self.player.underruns,
+                    1000 * self.player.min_margin))
+        elif self.play and self.streaming:
+            while self.mixer_channel.get_busy():
+                pygame.time.wait(10)
+        elif self.play:
+            self.log('Starting playback...')
+            sound.play()
+            pygame.time.wait(math.ceil(self.fullduration))
+
+        if self.streaming:
+            self.peak_memory = self.get_peak_memory()
+            if self.peak_memory is not None:
+                self.log('Peak memory usage was {:.1f} MiB.'.format(
+                        self.peak_memory / 2 ** 20))
+
+    def stream(self, blocksize=None, sampleformat=None):
+        """
+        stream(blocksize: int = None, sampleformat: str = None) -> iterator
+
+        Generate the sound and yield it in blocks of blocksize frames (by
+        default the block size of the SoundCore; the last block may be
+        shorter) of interleaved samples: numpy float arrays of values between
+        -1 and 1, or bytes in sampleformat (one of generate.sample_formats)
+        if given. Nothing is written, played or cached.
+        """
+        if blocksize is not None:
+            if blocksize < 1:
+                raise ValueError('the block size must be at least 1 frame')
+            self.blocksize = blocksize
+        if sampleformat is not None and sampleformat not in sample_formats:
+            raise ValueError('{} is not an accepted sample format'.format(
+                    repr(sampleformat)))
+        return self._stream(sampleformat)
+
+    def _stream(self, sampleformat):
+        self.prepare()
+        for block in self.get_sample_blocks():
+            self.instruments.count('samples', len(block))
+            yield block if sampleformat is None else to_bytes(
+                block, sampleformat)
+        if self.engine != 'python':
+            self._count_columns()
+
+    def _count_columns(self):
+        for key, n in zip(('columns', 'silent_columns', 'reused_columns',
+                           'audible_pixels'), self.column_counts):
+            self.instruments.count(key, n)
+
+    @property
+    def stats(self):
+        """
+        The seconds spent in each stage of the render and the counts of what
+        was done, as {'seconds': {stage: seconds}, 'counts': {what: count}}.
+        Empty unless enabled with SoundCore(stats=True). The stages are
+        decode and analyse (in load), setup (in prepare), cache_key,
+        synthesis (of which wavefunc, with the python engine) and convert, or
+        read for a cached sound, write and play, and run for all of run.
+        """
+        return self.instruments.as_dict()
+
+    def write_stats(self, f):
+        """Write stats as JSON to the path or file object f."""
+        text = json.dumps(self.stats, indent=2, sort_keys=True)
+        if isinstance(f, str):
+            with open(f, 'w') as f:
+                print(text, file=f)
+        else:
+            print(text, file=f)
+
+    async def astream(self, blocksize=None, sampleformat=None, executor=None):
+        """
+        Like stream, but an asynchronous iterator. The blocks are generated
+        in executor (by default the one of the event loop), so that the loop
+        keeps running meanwhile.
+        """
+        loop = asyncio.get_running_loop()
+        blocks, done = self.stream(blocksize, sampleformat), object()
+        try:
+            while True:
+                block = await loop.run_in_executor(executor, next, blocks, done)
+                if block is done:
+                    return
+                yield block
+        finally:
+            try:
+                blocks.close()
+            except ValueError:
+                pass # Still running in the executor after a cancellation
+
+    def play_block(self, data, start):
+        """
+        Send a block of 16-bit samples starting at sample number start to the
+        mixer: to the real-time player with --play-at-once, else (in stream
+        mode) queue it on the mixer, waiting until the block before it has
+        started playing, or else store it in the buffer of the whole sound.
+        """
+        if self.playatonce:
+            self.player.write(data)
+            return
+        if not self.streaming:
+            self.soundarr[start:start + len(data)] = data
+            return
+        import pygame
+        if self.channels > 1:
+            data = data.reshape(-1, self.channels)
+        sound = pygame.sndarray.make_sound(data)
+        while self.mixer_channel.get_queue() is not None:
+            pygame.time.wait(1)
+        self.mixer_channel.queue(sound)
+
+    def get_peak_memory(self):
+        """
+        get_peak_memory() -> int
+
+        Get the peak resident memory of the process in bytes, or None if the
+        platform cannot tell.
+        """
+        if resource is None:
+            return None
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
 
     def end(self):
         """Finalize objects."""
         SoundGenerator.end(self)
-        if self.outputformat == 'wav':
+        if self.wavof is not None:
             self.wavof.close()
         if self.play:
+            import pygame
             pygame.mixer.quit()
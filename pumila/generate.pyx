@@ -26,12 +26,145 @@ Generates sound.
 import itertools
 import colorsys
 import math
-import struct
+import multiprocessing
+import collections
+import hashlib
+import time
+import numpy
 from . import primitives
 
 cdef double _onefour, _twofour, _threefour
 _onefour, _twofour, _threefour = 1./4, 2./4, 3./4
 
+# 'python' calls one closure per pixel per sample; 'numpy' computes a whole
+# column at a time with array expressions. The two agree to within rounding
+# noise far below one 16-bit step, except for the odd sample that lands on the
+# edge of a square or sawtooth wave, since the numpy engine computes time as
+# sample number / framerate instead of accumulating 1 / framerate. 'wavetable'
+# works like 'numpy', but looks the waves up in primitives.WavetableBank
+# oscillators instead of computing them. 'fft' synthesizes every column in the
+# frequency domain (see primitives.SpectralBank), at a cost that grows with the
+# number of distinct frequencies rather than with their number times the
+# column length; its sound is band-limited and crossfades from column to
+# column, and its largest error from the exact band-limited sound is about
+# 74 dB below the peak of the sound. With bandlimited, the numpy
+# engine rounds the edges and corners of the waves off with PolyBLEP and
+# PolyBLAMP, and the wavetable engine uses tables with fewer harmonics for
+# higher octaves, so that neither aliases much.
+engines = ('python', 'numpy', 'wavetable', 'fft')
+
+# Increase whenever an engine changes its output, so that cached sounds made by
+# older versions are not used
+engines_version = 4
+
+# How the sum of the pixels of a column is brought to between -1 and 1.
+# 'count' divides every column by its number of audible pixels, so that its
+# loudness jumps with that number; 'none' leaves the sum alone; 'peak' and
+# 'rms' apply one gain to the whole sound, worked out from the pixel tables
+# before synthesis (see SoundCore.column_levels), so that the upper bound of
+# its amplitude or the estimate of its RMS level meets a target ('rms' also
+# softly limits the sound to 0 dBFS if it may go above); 'limit' leaves the
+# sum alone, but softly limits the samples to a ceiling (see soft_limit).
+normalizations = ('none', 'count', 'peak', 'rms', 'limit')
+
+# The default targets of the normalizations that take one, in dBFS
+normalization_levels = {'peak': 0, 'rms': -20, 'limit': -1}
+
+# The shapes of the ramps that fade from column to column
+ramp_shapes = ('linear', 'cosine')
+
+# The attributes a block engine needs, which are sent to worker processes
+_block_state = ('engine', 'framerate', 'channels', 'one_pixel_samples_len',
+                'imgs_range', 'gains', 'channel_gains', 'tables', 'oscillators',
+                'oscillator_lengths', 'row_oscillators', 'bank', 'spectral_bank',
+                'phasereset', 'normalization', 'ramp_envelope', 'bandlimited')
+
+# How much memory the blocks kept for reuse by identical columns may take
+_memo_bytes = 64 * 2 ** 20
+
+def ramp_envelope(shape, int length):
+    """
+    ramp_envelope(shape: str, length: int) -> array
+
+    Get length gains rising from 0 to 1 along a line or a raised cosine
+    (shape is one of ramp_shapes), taken at the middle of every frame.
+    """
+    x = (numpy.arange(length) + 0.5) / length
+    return x if shape == 'linear' else 0.5 - 0.5 * numpy.cos(math.pi * x)
+
+def soft_limit(block, level):
+    """
+    soft_limit(block: array, level: float) -> array
+
+    Limit the samples of block to between -level and level in place and
+    return it. Samples up to half of level pass unchanged, and louder ones
+    approach level along a tanh curve that starts with the same slope.
+    """
+    knee = level / 2
+    loud = numpy.abs(block) > knee
+    x = block[loud]
+    block[loud] = numpy.sign(x) * (knee + knee * numpy.tanh(
+            (numpy.abs(x) - knee) / knee))
+    return block
+
+def to_int16(block):
+    """
+    to_int16(block: array) -> array
+
+    Convert floats between -1 and 1 to little-endian 16-bit integers, rounding
+    towards zero like int(x * 32767) and clipping values outside the range.
+    """
+    return numpy.clip(block * 32767, -32768, 32767).astype('<i2')
+
+# Name: (bits, whether the samples are floats)
+sample_formats = {
+    'u8':  (8, False),
+    's16': (16, False),
+    's24': (24, False),
+    's32': (32, False),
+    'f32': (32, True),
+    }
+
+def to_bytes(block, fmt):
+    """
+    to_bytes(block: array, fmt: str) -> bytes
+
+    Convert floats between -1 and 1 to the little-endian WAVE representation
+    of the sample format fmt (a key of sample_formats). Integers are rounded
+    towards zero and clipped like in to_int16, and 8-bit samples are unsigned.
+    """
+    if fmt == 's16':
+        return to_int16(block).tobytes()
+    if fmt == 'f32':
+        return block.astype('<f4').tobytes()
+    top = 2 ** (sample_formats[fmt][0] - 1) - 1
+    data = numpy.clip(block * top, -top - 1, top).astype('<i4')
+    if fmt == 'u8':
+        return (data + 128).astype(numpy.uint8).tobytes()
+    if fmt == 's24':
+        return data.view(numpy.uint8).reshape(-1, 4)[:, :3].tobytes()
+    return data.tobytes()
+
+def from_bytes(data, fmt):
+    """
+    from_bytes(data: bytes, fmt: str) -> array
+
+    Convert the output of to_bytes back to floats between -1 and 1.
+    """
+    if fmt == 'f32':
+        return numpy.frombuffer(data, dtype='<f4').astype(numpy.float64)
+    top = 2 ** (sample_formats[fmt][0] - 1) - 1
+    if fmt == 'u8':
+        values = numpy.frombuffer(data, dtype=numpy.uint8).astype(int) - 128
+    elif fmt == 's24':
+        b = numpy.frombuffer(data, dtype=numpy.uint8).reshape(-1, 3).astype(
+            numpy.int32)
+        values = ((b[:, 0] | b[:, 1] << 8 | b[:, 2] << 16) ^ 0x800000) - 0x800000
+    else:
+        values = numpy.frombuffer(data, dtype='<i{}'.format(
+                sample_formats[fmt][0] // 8))
+    return values / top
+
 cdef class SoundGenerator:
     """
     The actual resource-demanding sound wave generation. Only works when
@@ -39,21 +172,317 @@ cdef class SoundGenerator:
     """
 
     def get_samples(self):
+        """
+        Yield samples as floats between -1 and 1, each repeated once for every
+        channel.
+        """
+        if self.engine == 'python':
+            return self._get_python_samples()
+        return self._get_block_samples()
+
+    def _get_block_samples(self):
+        for block in self.get_sample_blocks():
+            for x in block.ravel().tolist():
+                yield x
+
+    def get_blocks(self):
+        """
+        Yield the frames of every pixel column as a numpy array of shape
+        (frames, channels). With the fft engine, the blocks are the sums of
+        the overlapping frames of the columns, and do not line up with them.
+        """
+        if self.engine == 'fft':
+            return self._overlap_add(self._get_columns())
+        return self._get_columns()
+
+    def _overlap_add(self, frames):
+        # Every frame starts half a column before its column and lasts two
+        # columns (see primitives.SpectralBank); frames that started before
+        # sample 0 are cut.
+        cdef int length = self.one_pixel_samples_len
+        cdef int offset = length // 2
+        total = numpy.zeros((2 * length, self.channels))
+        first = True
+        for frame in frames:
+            total += frame
+            yield total[offset:length] if first else total[:length]
+            first = False
+            total = numpy.concatenate((total[length:],
+                                       numpy.zeros((length, self.channels))))
+        if not first:
+            yield total[:offset]
+
+    def _get_columns(self):
+        cdef int x, width, chunk
+        width = max(table.width for table in self.tables)
+        self._reset_memo()
+        if self.workers <= 1:
+            for x in range(width):
+                yield self.render_column(x)
+            return
+
+        # Every block only depends on its absolute sample numbers, so chunks
+        # of columns can be rendered in any process and stitched together.
+        chunk = max(1, width // (self.workers * 4))
+        state = {k: getattr(self, k) for k in _block_state if hasattr(self, k)}
+        # Tables that keep one strip at a time would take the whole images
+        # along to the workers; send the columns of each chunk instead.
+        strips = any(table.strips for table in self.tables)
+        if strips:
+            del state['tables']
+        pool = multiprocessing.Pool(self.workers, _init_worker, (state,))
+        try:
+            # Only keep a few chunks in flight, so that memory use does not
+            # grow with the width of the images.
+            pending = collections.deque()
+            for x in range(0, width, chunk):
+                columns = range(x, min(x + chunk, width))
+                tables = None
+                if strips:
+                    tables = [_ColumnTable(table, range(
+                                max(0, x - 1), min(x + chunk, table.width)))
+                              for table in self.tables]
+                pending.append(pool.apply_async(
+                        _render_columns, (columns, tables)))
+                if len(pending) < self.workers * 2:
+                    continue
+                for block in self._collect(pending.popleft()):
+                    yield block
+            while pending:
+                for block in self._collect(pending.popleft()):
+                    yield block
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _collect(self, result):
+        blocks, counts = result.get()
+        for i in range(len(counts)):
+            self.column_counts[i] += counts[i]
+        return blocks
+
+    def _reset_memo(self):
+        # [columns, silent columns, reused columns, audible pixels]
+        self.column_counts = [0, 0, 0, 0]
+        self._memo = collections.OrderedDict()
+        self._last_weights = (None, None)
+        # Blocks can only be reused if oscillators can be in exactly the same
+        # phases again (see _in_phase)
+        self._memoize = self.phasereset or self.engine == 'wavetable'
+        self._memo_size = max(1, _memo_bytes // (
+                self.one_pixel_samples_len * self.channels * 8 *
+                (2 if self.engine == 'fft' else 1)))
+
+    def render_column(self, int x):
+        """
+        Get the block of column x like column_to_block, but make silent columns
+        directly, and reuse the block of an earlier identical column if all its
+        oscillators are in exactly the same phases now (always the case if
+        phasereset, where every column starts at phase 0; otherwise only
+        possible with the wavetable engine, and blocks are not kept for reuse
+        at all with the others). With a ramp, a column is only
+        identical to another if the columns before them are too. The number of
+        columns, silent columns, reused columns and audible pixels are counted
+        in column_counts.
+        """
+        cdef int length = self.one_pixel_samples_len
+        start = 0 if self.phasereset else x * length
+        self.column_counts[0] += 1
+        key, steps = self._column_key(x)
+        if key is None:
+            self.column_counts[1] += 1
+            return numpy.zeros((2 * length if self.engine == 'fft' else length,
+                                self.channels))
+        self.column_counts[3] += len(steps)
+        if not self._memoize:
+            return self.column_to_block(x, start, length)
+        memo = self._memo.get(key)
+        if memo is not None and self._in_phase(start - memo[0], steps):
+            self.column_counts[2] += 1
+            return memo[1]
+        block = self.column_to_block(x, start, length)
+        if memo is None:
+            self._memo[key] = (start, block)
+            if len(self._memo) > self._memo_size:
+                self._memo.popitem(False)
+        return block
+
+    def _column_key(self, int x):
+        # Hash the pixel tables of column x (and of the column before it, which
+        # a ramp fades out during it), and get the wavetable increments of
+        # their audible pixels. The hash is only worked out if blocks are
+        # memoized; the key is None if the columns are silent.
+        h = hashlib.sha1() if self._memoize else None
+        steps = []
+        columns = [x - 1, x] if self.ramp_envelope is not None else [x]
+        for i in columns:
+            if h is not None:
+                h.update(b'|')
+            for j in self.imgs_range:
+                if not 0 <= i < self.tables[j].width:
+                    continue
+                column = self.tables[j].column(i)
+                rows = column[0]
+                if len(rows) == 0:
+                    continue
+                if h is not None:
+                    h.update(str(j).encode())
+                    for arr in column:
+                        h.update(arr)
+                oscs = self.row_oscillators[j][rows]
+                steps.append(self.bank.increments[oscs]
+                             if self.engine == 'wavetable' else oscs)
+        if not steps:
+            return None, None
+        return (h.digest() if h is not None else b''), \
+            numpy.concatenate(steps)
+
+    def _in_phase(self, diff, steps):
+        # Whether oscillators with the given steps are in exactly the same
+        # phases diff samples later. Only the integer phases of the wavetable
+        # engine can tell without rounding errors; the numpy engine must not
+        # reuse blocks that a fresh render would round differently, or the
+        # result would depend on the number of workers.
+        if diff == 0:
+            return True
+        if self.engine == 'wavetable':
+            return not numpy.any((steps * numpy.uint64(diff)) &
+                                 numpy.uint64(0xffffffff))
+        return False
+
+    def column_to_block(self, int x, start, int length):
+        """
+        Mix the pixels in column x of every image into one block of the
+        frames from sample number start to start + length, as an array of
+        shape (length, channels), or, with the fft engine, the frame of
+        2 * length frames that overlaps with the ones around it.
+
+        The weights of the pixels of all images are summed per oscillator
+        (see SoundCore.oscillators), wave and channel first, so that every
+        oscillator is evaluated at most once per wave, however many images
+        use it. With a ramp_envelope, the weights of the first frames move
+        from those of column x - 1 to those of column x along it.
+        """
+        weights = self.column_weights(x)
+        ramp = self.ramp_envelope
+        if ramp is not None:
+            # Consecutive columns are mostly rendered one after the other
+            last, before = self._last_weights
+            if last != x - 1:
+                before = self.column_weights(x - 1)
+            self._last_weights = (x, weights)
+            if before is None and weights is None:
+                return numpy.zeros((length, self.channels))
+            if weights is None:
+                weights = numpy.zeros_like(before)
+            before = -weights if before is None else before - weights
+        elif weights is None:
+            return numpy.zeros((2 * length if self.engine == 'fft' else length,
+                                self.channels))
+        if self.engine == 'fft':
+            return self.spectral_bank.render(weights, start)
+        t = numpy.arange(start, start + length, dtype=numpy.float64) / \
+            self.framerate if self.engine == 'numpy' else None
+        total = numpy.zeros((length, self.channels))
+        if ramp is not None:
+            n = len(ramp)
+            fade = numpy.zeros((n, self.channels))
+        for k, wave in enumerate(primitives.wave_arrays):
+            active = weights[k].any(axis=1)
+            used = numpy.flatnonzero(active)
+            if len(used):
+                waves = self._waves(k, wave, used, start, length, t)
+                total += numpy.dot(waves.T, weights[k, used])
+            if ramp is None:
+                continue
+            # The difference from the weights of column x fades out; the
+            # oscillators that only column x - 1 uses are only needed then.
+            if len(used):
+                fade += numpy.dot(waves[:, :n].T, before[k, used])
+            gone = numpy.flatnonzero(before[k].any(axis=1) & ~active)
+            if len(gone):
+                fade += numpy.dot(self._waves(k, wave, gone, start, n,
+                                              t[:n] if t is not None
+                                              else None).T, before[k, gone])
+        if ramp is not None:
+            total[:n] += fade * (1 - ramp)[:, None]
+        return total
+
+    def _waves(self, int k, wave, oscs, start, int length, t):
+        # The values of the wave at index k of wave_arrays of the oscillators
+        # oscs, from sample number start on (or at the times t with the numpy
+        # engine), as an array of shape (len(oscs), length)
+        if self.engine == 'wavetable':
+            return self.bank.render(k, oscs, start, length)
+        ls = self.oscillator_lengths[oscs]
+        if self.bandlimited:
+            return primitives.blep_arrays[k](
+                t, self.oscillators[oscs, None], ls[:, 0, None],
+                ls[:, 1, None], ls[:, 2, None], ls[:, 3, None],
+                1 / (ls[:, 3, None] * self.framerate))
+        return wave(t, self.oscillators[oscs, None], ls[:, 0, None],
+                    ls[:, 1, None], ls[:, 2, None], ls[:, 3, None])
+
+    def column_weights(self, int x):
+        """
+        column_weights(x: int) -> array or None
+
+        Get the weights of the pixels in column x of every image as an array
+        of shape (waves, oscillators, channels), with the weight of each wave
+        in primitives.wave_arrays for each oscillator and channel, normalized
+        if by count, or None if the column is silent.
+        """
+        weights = numpy.zeros((len(primitives.wave_arrays),
+                               len(self.oscillators), self.channels))
+        incr = 0
+        for j in self.imgs_range:
+            if not 0 <= x < self.tables[j].width:
+                continue
+            # Only the audible pixels are stored, so only their oscillators
+            # are touched.
+            rows, amp, wa, wb, pair = self.tables[j].column(x)
+            if len(rows) == 0:
+                continue
+            incr += len(rows)
+            amp = self.gains[j] * amp
+            oscs = self.row_oscillators[j][rows]
+            gains = self.channel_gains[j]
+            numpy.add.at(weights, (pair, oscs), (amp * wa)[:, None] * gains)
+            numpy.add.at(weights, ((pair + 1) % 4, oscs),
+                         (amp * wb)[:, None] * gains)
+        if incr == 0:
+            return None
+        if self.normalization == 'count':
+            # Scaling the weights is cheaper than dividing every sample
+            weights /= incr
+        return weights
+
+    def _get_python_samples(self):
         cdef int i, j, incr, channels, onepixsamplen
         cdef double sampnum, step, total
         channels, onepixsamplen = self.channels, self.one_pixel_samples_len
         sampnum, step = 0, 1.0 / self.framerate
         imgs_range, freq_range, gains = self.imgs_range, self.freq_range, self.gains
         rgbs, alphas = self.rgbs, self.alphas
+        stats = self.instruments
+        timed = stats.enabled
         for imgsrgb, imgsalpha in itertools.zip_longest(
             itertools.zip_longest(*rgbs),
             itertools.zip_longest(*alphas)):
+            if timed:
+                t = time.perf_counter()
             pvars = tuple(tuple(filter(lambda x: x is not None,
                     (self.rgbafg_to_wavefunc(rgb[0], rgb[1], rgb[2], a, freq, gain)
                     for rgb, a, freq in (itertools.zip_longest(
                                     imgsrgb[j], imgsalpha[j], freq_range[j])))))
                           if imgsalpha[j] is not None else None
                           for j, gain in itertools.zip_longest(imgs_range, gains))
+            if timed:
+                stats.lap('wavefunc', t)
+                stats.counts['columns'] += 1
+                stats.counts['audible_pixels'] += sum(
+                    len(pvar) for pvar in pvars if pvar is not None)
 
             for i in range(onepixsamplen):
                 total, incr = 0, 0
@@ -102,62 +531,144 @@ cdef class SoundGenerator:
             return amp * (aw(s, freq, l1, l2, l3, l4) * ar + bw(s, freq, l1, l2, l3, l4) * br)
         return _wf
 
+    def get_sample_blocks(self):
+        """
+        Yield the samples of get_samples as numpy arrays of blocksize frames
+        (the last block may be shorter), normalized by norm_gain and, with
+        the limit normalization, soft_limit.
+        """
+        for block in self._get_raw_blocks():
+            # Every block is a fresh array, so it can be changed in place
+            if self.norm_gain != 1:
+                block *= self.norm_gain
+            if self.norm_limit is not None:
+                soft_limit(block, self.norm_limit)
+            yield block
+
+    def _get_raw_blocks(self):
+        cdef int blocklen = self.blocksize * self.channels
+        if self.engine == 'python':
+            samples = self._get_python_samples()
+            while True:
+                block = numpy.fromiter(itertools.islice(samples, blocklen),
+                                       dtype=numpy.float64)
+                if len(block) == 0:
+                    return
+                yield block
+        pending, npending = [], 0
+        for block in self.get_blocks():
+            # (frames, channels) in C order is already interleaved
+            pending.append(block.ravel())
+            npending += len(pending[-1])
+            if npending < blocklen:
+                continue
+            data = numpy.concatenate(pending)
+            for i in range(0, len(data) - blocklen + 1, blocklen):
+                yield data[i:i + blocklen]
+            rest = data[len(data) - len(data) % blocklen:]
+            pending, npending = [rest], len(rest)
+        if npending:
+            yield numpy.concatenate(pending)
+
     def generate(self):
-        cdef int i, j, pbar_interval
-        if self.showprogressbar:
-            pbar_interval, pbar_update = self.pbar_interval, self.pbar.update
-        if self.outputformat == 'wav':
-            wavof = self.wavof
-            def wavof_write(val):
-                wavof.writeframesraw(struct.pack('<h', val))
-        if self.play:
-            soundarr = self.soundarr
-            i, j = self.sound_offset, 0
-            if self.outputformat == 'wav':
-                if self.showprogressbar:
-                    for x in self.get_samples():
-                        if j % pbar_interval == 0: pbar_update(j)
-                        val = int(x * 32767)
-                        soundarr[i] = val
-                        wavof_write(val)
-                        i += 1; j += 1
-                else:
-                    for x in self.get_samples():
-                        val = int(x * 32767)
-                        soundarr[i] = val
-                        wavof_write(val)
-                        i += 1; j += 1
-            else:
-                if self.showprogressbar:
-                    for x in self.get_samples():
-                        if j % pbar_interval == 0: pbar_update(j)
-                        soundarr[i] = int(x * 32767)
-                        i += 1; j += 1
-                else:
-                    for x in self.get_samples():
-                        soundarr[i] = int(x * 32767)
-                        i += 1; j += 1
-        elif self.outputformat == 'wav':
-            i = 0
+        """
+        Generate all samples and write them to the outputs block by block.
+        With enabled instruments, the time spent in each step is measured.
+        """
+        cdef long i = 0
+        stats = self.instruments
+        timed = stats.enabled
+        if timed:
+            t = time.perf_counter()
+        for block in self.get_sample_blocks():
+            if timed:
+                t = stats.lap('synthesis', t)
+            if self.wavof is not None or self.cache_entry is not None:
+                data = to_bytes(block, self.sampleformat)
+                if timed:
+                    t = stats.lap('convert', t)
+                if self.wavof is not None:
+                    self.wavof.writeframesraw(data)
+                if self.cache_entry is not None:
+                    self.cache_entry.write(data)
+                if timed:
+                    t = stats.lap('write', t)
+                    stats.counts['bytes_written'] += len(data)
+            if self.play:
+                self.play_block(to_int16(block), i)
+                if timed:
+                    t = stats.lap('play', t)
+            i += len(block)
             if self.showprogressbar:
-                for x in self.get_samples():
-                    if i % pbar_interval == 0: pbar_update(i)
-                    wavof_write(int(x * 32767))
-                    i += 1
-            else:
-                for x in self.get_samples():
-                    wavof_write(int(x * 32767))
-                    i += 1
-        else:
+                self.pbar.update(i)
+        stats.count('samples', i)
+
+    def replay(self, f):
+        """
+        Send samples that have already been generated, in the sample format
+        of the outputs, from the file object f to the outputs. With enabled
+        instruments, the time spent in each step is measured.
+        """
+        cdef long i = 0
+        cdef int width = sample_formats[self.sampleformat][0] // 8
+        stats = self.instruments
+        timed = stats.enabled
+        if timed:
+            t = time.perf_counter()
+        while True:
+            data = f.read(self.blocksize * self.channels * width)
+            if timed:
+                t = stats.lap('read', t)
+            if not data:
+                break
+            if self.wavof is not None:
+                self.wavof.writeframesraw(data)
+                if timed:
+                    t = stats.lap('write', t)
+                    stats.counts['bytes_written'] += len(data)
+            if self.play:
+                if self.sampleformat == 's16':
+                    samples = numpy.frombuffer(data, dtype='<i2')
+                else:
+                    samples = to_int16(from_bytes(data, self.sampleformat))
+                self.play_block(samples, i)
+                if timed:
+                    t = stats.lap('play', t)
+            i += len(data) // width
             if self.showprogressbar:
-                i = 0
-                for x in self.get_samples():
-                    if i % pbar_interval == 0: pbar_update(i)
-                    i += 1
-            else:
-                for x in self.get_samples():
-                    pass
+                self.pbar.update(i)
+        stats.count('samples', i)
 
     def end(self):
         """Finalize objects."""
         pass
+
+
+class _Worker(SoundGenerator):
+    pass
+
+class _ColumnTable(object):
+    # The columns in columns of an image.PixelTable (and its width), to send
+    # to a worker instead of the table
+    def __init__(self, table, columns):
+        self.width = table.width
+        self.strips = False
+        self._columns = {x: table.column(x) for x in columns}
+
+    def column(self, x):
+        return self._columns[x]
+
+_worker = None
+
+def _init_worker(state):
+    global _worker
+    _worker = _Worker()
+    _worker.__dict__.update(state)
+    _worker._reset_memo()
+
+def _render_columns(columns, tables=None):
+    if tables is not None:
+        _worker.tables = tables
+    _worker.column_counts = [0, 0, 0, 0]
+    blocks = [_worker.render_column(x) for x in columns]
+    return blocks, _worker.column_counts
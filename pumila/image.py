@@ -24,21 +24,146 @@ Loads images.
 
 import sys
 import os.path
-import tempfile
+import io
+import importlib.util
+import struct
+import zlib
 import zipfile
-import re
-import pygame
+import xml.etree.ElementTree as ElementTree
+from multiprocessing.pool import ThreadPool
 import numpy
+from . import png
 
-def load(path):
-    """Load image from path."""
+# Image decoders, in the order tried when none is chosen. 'png' is built in
+# and decodes only PNG images, but needs neither Pillow nor pygame. PNG images
+# are never decoded with pygame unless asked for: importing pygame prints a
+# banner to standard out, where the sound may be written.
+backends = ('pillow', 'pygame', 'png')
+_png_backends = ('pillow', 'png')
+_modules = {'pillow': 'PIL', 'pygame': 'pygame'}
+
+# How many columns to analyse at a time; bounds the temporary arrays
+_strip_width = 256
+
+# The raw format: this magic, the width and the height as little-endian 32-bit
+# unsigned integers, and then the pixels as R, G, B, A bytes, column by column
+# from the left, each column from the top. Columns are contiguous, so that the
+# generator, which goes through the image column by column, reads the file
+# from start to end.
+raw_magic = b'PUMILARW'
+_raw_header = struct.Struct('<8sII')
+
+def load(path, backend=None):
+    """
+    Load image from path, decoding it with the image backend backend (one of
+    backends; by default the first one available that decodes the image).
+    """
     if path.endswith('.ora'):
-        return load_ora(path)
+        return load_ora(path, backend=backend)
+    with open(path, 'rb') as f:
+        if f.read(len(raw_magic)) == raw_magic:
+            return load_raw(path)
+    return _load_surface(path, backend=backend)
+
+def load_raw(path):
+    """
+    Load an image in the raw format (see raw_magic) from path. The pixels are
+    memory-mapped, so they are only read from disk when used.
+    """
+    with open(path, 'rb') as f:
+        magic, width, height = _raw_header.unpack(f.read(_raw_header.size))
+    if magic != raw_magic:
+        raise ValueError('file {} is not a raw image'.format(repr(path)))
+    pixels = numpy.memmap(path, dtype=numpy.uint8, mode='r',
+                          offset=_raw_header.size, shape=(width, height, 4))
+    return (pixels[..., :3], pixels[..., 3])
+
+def save_raw(path, rgb, alpha):
+    """Save an image given as (rgb, alpha) arrays to path in the raw format."""
+    width, height = alpha.shape
+    with open(path, 'wb') as f:
+        f.write(_raw_header.pack(raw_magic, width, height))
+        for x in range(0, width, _strip_width):
+            strip = numpy.empty((len(alpha[x:x + _strip_width]), height, 4),
+                                dtype=numpy.uint8)
+            strip[..., :3] = rgb[x:x + _strip_width]
+            strip[..., 3] = alpha[x:x + _strip_width]
+            f.write(strip.tobytes())
+
+def convert(inpath, outpath):
+    """
+    convert(inpath: str, outpath: str) -> [str]
+
+    Convert any loadable image to the raw format and return the paths written
+    to. The layers of an OpenRaster file are written to numbered files.
+    """
+    loaded = load(inpath)
+    if isinstance(loaded[0], tuple):
+        base, ext = os.path.splitext(outpath)
+        paths = ['{}-{:03d}{}'.format(base, i, ext) for i in range(len(loaded))]
+    else:
+        loaded, paths = (loaded,), [outpath]
+    for path, (rgb, alpha) in zip(paths, loaded):
+        save_raw(path, rgb, alpha)
+    return paths
+
+def available_backend(backend=None, pngdata=False):
+    """
+    available_backend(backend: str = None, pngdata: bool = False) -> str
+
+    Return backend if it can be used, or else the first available backend
+    that can decode PNG images if pngdata and other images if not. Backends
+    are looked up without being imported. Raise ValueError if none can be
+    used.
+    """
+    if backend is None:
+        names = _png_backends if pngdata else backends[:2]
+    else:
+        names = (backend,)
+    for name in names:
+        if name not in backends:
+            raise ValueError('unknown image backend {}'.format(repr(name)))
+        if name not in _modules or \
+                importlib.util.find_spec(_modules[name]) is not None:
+            return name
+    raise ValueError('image backend {} is not available'.format(repr(backend)))
+
+def _is_png(source):
+    if isinstance(source, str):
+        with open(source, 'rb') as f:
+            return f.read(len(png.signature)) == png.signature
+    pos = source.tell()
+    data = source.read(len(png.signature))
+    source.seek(pos)
+    return data == png.signature
+
+def _load_surface(source, namehint='', backend=None):
+    backend = available_backend(
+        backend, pngdata=backend is None and _is_png(source))
+    if isinstance(source, str):
+        namehint = namehint or source
+    try:
+        return _decoders[backend](source, namehint)
+    except ValueError:
+        raise ValueError('file {} is not loadable'.format(repr(namehint)))
+
+def _decode_pillow(source, namehint):
+    import PIL.Image
+    try:
+        img = PIL.Image.open(source)
+        img = img.convert('RGBA')
+    except (IOError, SyntaxError):
+        raise ValueError()
+    pixels = numpy.asarray(img).transpose(1, 0, 2)
+    return (pixels[..., :3], pixels[..., 3])
+
+def _decode_pygame(source, namehint):
+    import pygame
     try:
-        surf = pygame.image.load(path)
+        surf = pygame.image.load(source, namehint)
         try:
             rgb = pygame.surfarray.pixels3d(surf)
-        except pygame.error:
+        except (ValueError, pygame.error):
             rgb = pygame.surfarray.array3d(surf)
         try:
             alpha = pygame.surfarray.pixels_alpha(surf)
@@ -47,19 +172,199 @@ def load(path):
             alpha[:] = 255
         return (rgb, alpha)
     except pygame.error:
-        raise ValueError('file {} is not loadable'.format(repr(path)))
-
-def load_ora(path):
-    """Load OpenRaster image from path."""
-
-    temp_path = tempfile.mkdtemp()
-    zf = zipfile.ZipFile(path)
-    zf.extractall(temp_path)
-
-    with open(os.path.join(temp_path, 'stack.xml')) as f:
-        xml = f.read()
-        
-    files = sorted(filter(lambda x: not x.endswith('background.png'),
-                          ('{}/{}'.format(temp_path, x.strip('"\''))
-                           for x in re.findall(r'src=(.+?.png)', xml))))
-    return tuple(map(load, files))
+        raise ValueError()
+
+def _decode_png(source, namehint):
+    if isinstance(source, str):
+        with open(source, 'rb') as f:
+            source = f.read()
+    else:
+        source = source.read()
+    try:
+        return png.decode(source)
+    except (KeyError, IndexError, TypeError, struct.error, zlib.error):
+        raise ValueError()
+
+_decoders = {'pillow': _decode_pillow, 'pygame': _decode_pygame,
+             'png': _decode_png}
+
+def save_png(path, rgb, alpha):
+    """Save an image given as (rgb, alpha) arrays to path as a PNG image."""
+    with open(path, 'wb') as f:
+        f.write(png.encode(rgb, alpha))
+
+def load_ora(path, threads=None, backend=None):
+    """
+    Load OpenRaster image from path.
+
+    Return the visible layers as separate images the size of the whole image,
+    with their offsets and opacities, and those of the stacks they are in,
+    applied. Layers in hidden stacks are left out. Layers are decoded straight
+    from the file, using threads threads (by default one per CPU) and the
+    image backend backend.
+    """
+    with zipfile.ZipFile(path) as zf:
+        root = ElementTree.fromstring(zf.read('stack.xml'))
+        size = int(root.get('w')), int(root.get('h'))
+        layers = [x for x in _ora_layers(root)
+                  if not x[0].endswith('background.png')]
+        datas = [(zf.read(x[0]), x[0]) for x in layers]
+
+    def _load(args):
+        (data, src), (_, x, y, opacity) = args
+        rgb, alpha = _load_surface(io.BytesIO(data), src, backend)
+        return _place(rgb, alpha, size, int(x), int(y), opacity)
+
+    pool = ThreadPool(threads)
+    try:
+        return tuple(pool.map(_load, zip(datas, layers)))
+    finally:
+        pool.close()
+
+def _ora_layers(element, x=0.0, y=0.0, opacity=1.0):
+    # The visible layers in element, in order, as (src, x, y, opacity), with
+    # the offsets and opacities of the stacks they are in added up
+    for child in element:
+        if child.get('visibility', 'visible') == 'hidden':
+            continue
+        cx, cy = x + float(child.get('x', 0)), y + float(child.get('y', 0))
+        copacity = opacity * float(child.get('opacity', 1))
+        if child.tag == 'stack':
+            yield from _ora_layers(child, cx, cy, copacity)
+        elif child.tag == 'layer':
+            yield (child.get('src', ''), cx, cy, copacity)
+
+def _place(rgb, alpha, size, x, y, opacity):
+    # Put a layer at (x, y) on a transparent canvas of size, and scale its
+    # alpha by opacity.
+    if (x, y) == (0, 0) and alpha.shape == size and opacity >= 1:
+        return (rgb, alpha)
+    crgb = numpy.zeros(size + (3,), dtype=numpy.uint8)
+    calpha = numpy.zeros(size, dtype=numpy.uint8)
+    w, h = alpha.shape
+    cx, cy = slice(max(x, 0), min(x + w, size[0])), \
+        slice(max(y, 0), min(y + h, size[1]))
+    lx, ly = slice(cx.start - x, cx.stop - x), slice(cy.start - y, cy.stop - y)
+    if cx.start < cx.stop and cy.start < cy.stop:
+        crgb[cx, cy] = rgb[lx, ly]
+        calpha[cx, cy] = numpy.round(alpha[lx, ly] * min(max(opacity, 0), 1))
+    return (crgb, calpha)
+
+def rgb_to_hsv(r, g, b):
+    """
+    rgb_to_hsv(r: array, g: array, b: array) -> (array, array, array)
+
+    Like colorsys.rgb_to_hsv, but for arrays of floats between 0 and 1.
+    """
+    maxc = numpy.maximum(numpy.maximum(r, g), b)
+    minc = numpy.minimum(numpy.minimum(r, g), b)
+    v = maxc
+    span = maxc - minc
+    grey = span == 0
+    span = numpy.where(grey, 1, span)
+    s = numpy.where(grey, 0, span / numpy.where(maxc == 0, 1, maxc))
+    rc, gc, bc = (maxc - r) / span, (maxc - g) / span, (maxc - b) / span
+    h = numpy.where(r == maxc, bc - gc,
+                    numpy.where(g == maxc, 2.0 + rc - bc, 4.0 + gc - rc))
+    h = numpy.where(grey, 0, (h / 6.0) % 1.0)
+    return h, s, v
+
+class PixelTable:
+    """
+    The sound-relevant properties of the audible pixels of an image.
+
+    Pixels that are transparent or colorless are silent and not stored. The
+    others are stored column by column in compressed sparse form: the rows of
+    the audible pixels of column x are rows[indptr[x]:indptr[x + 1]], and the
+    same slice of amp, wa, wb and pair holds their properties. amp, wa and wb
+    are float32 arrays: amp is the amplitude before gain, and wa and wb are the
+    weights of the two waves the hue of the pixel lies between. pair is an int8
+    array with the index of the first of those waves in primitives.wave_arrays.
+    The table does not depend on any render settings, so it can be reused
+    between renders, and its size depends on the number of audible pixels
+    instead of on the size of the image.
+
+    If strips, only one strip of columns is analysed and kept at a time, when
+    one of its columns is requested with column(), so that the memory use does
+    not depend on the width of the image.
+    """
+
+    def __init__(self, rgb, alpha, strips=False):
+        self.width, self.height = alpha.shape
+        self.strips = strips
+        if strips:
+            self._source, self._start = (rgb, alpha), 0
+            self._set(*self._analyse(slice(0, _strip_width), rgb, alpha))
+            return
+        self._source = None
+        parts = [self._analyse(slice(x, x + _strip_width), rgb, alpha)
+                 for x in range(0, self.width, _strip_width)]
+        counts, rows, amp, wa, wb, pair = (
+            numpy.concatenate(x) if x else numpy.empty(0)
+            for x in zip(*parts))
+        self._set(counts, rows, amp, wa, wb, pair)
+
+    def _set(self, counts, rows, amp, wa, wb, pair):
+        self.indptr = numpy.zeros(len(counts) + 1, dtype=numpy.intp)
+        numpy.cumsum(counts, out=self.indptr[1:])
+        self.rows = rows.astype(numpy.intp)
+        self.amp, self.wa, self.wb = amp, wa, wb
+        self.pair = pair.astype(numpy.int8)
+
+    def column(self, x):
+        """
+        column(x: int) -> (array, array, array, array, array)
+
+        Get the rows, amp, wa, wb and pair arrays of the audible pixels in
+        column x.
+        """
+        if self._source is not None:
+            if not self._start <= x < self._start + len(self.indptr) - 1:
+                self._start = x - x % _strip_width
+                self._set(*self._analyse(
+                        slice(self._start, self._start + _strip_width),
+                        *self._source))
+            x -= self._start
+        cols = slice(self.indptr[x], self.indptr[x + 1])
+        return (self.rows[cols], self.amp[cols], self.wa[cols], self.wb[cols],
+                self.pair[cols])
+
+    def column_sums(self, f):
+        """
+        column_sums(f: function) -> array
+
+        Get the sum over the audible pixels of every column of f(rows, amp, wa,
+        wb, pair), which maps the arrays of the pixels to an array of one value
+        (or row of values) per pixel. The columns are analysed again if the
+        table keeps one strip at a time.
+        """
+        if self._source is None:
+            parts = [(numpy.diff(self.indptr), self.rows, self.amp, self.wa,
+                      self.wb, self.pair)]
+        else:
+            parts = (self._analyse(slice(x, x + _strip_width),
+                                   *self._source)
+                     for x in range(0, self.width, _strip_width))
+        sums = []
+        for counts, rows, amp, wa, wb, pair in parts:
+            values = numpy.asarray(f(rows, amp.astype(numpy.float64), wa, wb,
+                                     pair), dtype=numpy.float64)
+            total = numpy.zeros((len(values) + 1,) + values.shape[1:])
+            numpy.cumsum(values, axis=0, out=total[1:])
+            ends = numpy.cumsum(counts)
+            sums.append(total[ends] - total[ends - counts])
+        return numpy.concatenate(sums)
+
+    def _analyse(self, cols, rgb, alpha):
+        a, rgb = alpha[cols], rgb[cols]
+        r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+        # not transparent, and saturation > 0 (r == g == b == 0 means value == 0)
+        audible = (a != 0) & ~((r == g) & (g == b))
+        xs, rows = numpy.nonzero(audible)
+        a, r, g, b = a[audible], r[audible], g[audible], b[audible]
+        h, s, v = rgb_to_hsv(r / 255., g / 255., b / 255.)
+        pair = numpy.minimum((h * 4).astype(numpy.int8), 3)
+        amp = (4 * s * v * (a / 255.)).astype(numpy.float32)
+        wa = ((pair + 1) / 4. - h).astype(numpy.float32)
+        wb = (h - pair / 4.).astype(numpy.float32)
+        return audible.sum(1), rows, amp, wa, wb, pair
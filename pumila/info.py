@@ -50,6 +50,7 @@ home_dir = os.path.expanduser('~')
 localpaths = misc.AttributeDict(
     'dirs', [
         'root',        '.pumila',
+        'cache',       '{root}/cache',
         ],
     'files', [
         'logfile',     '{root}/.log',
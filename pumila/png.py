@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+# pumila: convert images to sound waves
+# Copyright (C) 2011 Niels Serup
+
+# This file is part of pumila.
+
+# pumila is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# pumila is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with pumila.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Reads and writes PNG images with nothing but zlib and numpy.
+"""
+
+import struct
+import zlib
+import numpy
+
+signature = b'\x89PNG\r\n\x1a\n'
+
+# Color type: number of samples per pixel
+_channels = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+# (x start, y start, x step, y step) of the seven Adam7 passes
+_adam7 = ((0, 0, 8, 8), (4, 0, 8, 8), (0, 4, 4, 8), (2, 0, 4, 4),
+          (0, 2, 2, 4), (1, 0, 2, 2), (0, 1, 1, 2))
+
+def _chunks(data):
+    pos = len(signature)
+    while pos + 8 <= len(data):
+        length, kind = struct.unpack('>I4s', data[pos:pos + 8])
+        body = data[pos + 8:pos + 8 + length]
+        crc, = struct.unpack('>I', data[pos + 8 + length:pos + 12 + length])
+        if zlib.crc32(kind + body) & 0xffffffff != crc:
+            raise ValueError('corrupt {} chunk'.format(kind.decode('latin-1')))
+        yield kind, body
+        if kind == b'IEND':
+            return
+        pos += 12 + length
+
+def _unfilter(kind, row, prior, bpp):
+    # Undo a None, Sub or Up filter of one row (a uint8 array) given the
+    # unfiltered row above it.
+    if kind == 0:
+        return row.copy()
+    if kind == 1:
+        return numpy.cumsum(row.reshape(-1, bpp), axis=0,
+                            dtype=numpy.uint8).reshape(-1)
+    return row + prior
+
+def _unfilter_diagonals(kinds, rows, bpp):
+    # Undo the filters of all rows at once. Every pixel only depends on the
+    # pixels to the left of, above and above left of it, so the pixels of
+    # each diagonal running up and to the right can be unfiltered together,
+    # Average and Paeth included. That takes height + width steps of numpy
+    # operations instead of a Python step per byte.
+    height, rowlen = rows.shape
+    width = rowlen // bpp
+    cur = rows.reshape(height, width, bpp).astype(numpy.int16)
+    # With a row of zeros above and a column of zeros to the left
+    out = numpy.zeros((height + 1, width + 1, bpp), dtype=numpy.int16)
+    kinds = kinds.astype(numpy.intp)
+    for d in range(height + width - 1):
+        ys = numpy.arange(max(0, d - width + 1), min(height, d + 1))
+        xs = d - ys
+        left, up, upleft = out[ys + 1, xs], out[ys, xs + 1], out[ys, xs]
+        k = kinds[ys]
+        pa, pb = numpy.abs(up - upleft), numpy.abs(left - upleft)
+        pc = numpy.abs(left + up - 2 * upleft)
+        paeth = numpy.where((pa <= pb) & (pa <= pc), left,
+                            numpy.where(pb <= pc, up, upleft))
+        # The predictions of the filter types 0 to 4, chosen by row
+        preds = numpy.stack((numpy.zeros_like(left), left, up,
+                             (left + up) >> 1, paeth))
+        out[ys + 1, xs + 1] = (cur[ys, xs] +
+                               preds[k, numpy.arange(len(ys))]) & 0xff
+    return out[1:, 1:].astype(numpy.uint8).reshape(height, rowlen)
+
+def _read_pass(raw, pos, width, height, depth, channels):
+    # Unfilter one (pass of an) image into a (height, width * channels) array
+    # of samples, and return it with the position after it in raw.
+    rowlen = (width * channels * depth + 7) // 8
+    bpp = max(1, channels * depth // 8)
+    data = numpy.frombuffer(raw, dtype=numpy.uint8, count=height * (rowlen + 1),
+                            offset=pos).reshape(height, rowlen + 1)
+    kinds, filtered = data[:, 0], data[:, 1:]
+    if height and kinds.max() > 4:
+        raise ValueError('unknown filter type {}'.format(kinds.max()))
+    if numpy.any(kinds >= 3):
+        rows = _unfilter_diagonals(kinds, filtered, bpp)
+    else:
+        rows = numpy.empty((height, rowlen), dtype=numpy.uint8)
+        prior = numpy.zeros(rowlen, dtype=numpy.uint8)
+        for y in range(height):
+            prior = rows[y] = _unfilter(kinds[y], filtered[y], prior, bpp)
+    pos += height * (rowlen + 1)
+    if depth == 16:
+        samples = rows.view('>u2')
+    elif depth < 8:
+        bits = numpy.unpackbits(rows, axis=1).reshape(height, -1, depth)
+        samples = numpy.zeros(bits.shape[:2], dtype=numpy.uint8)
+        for i in range(depth):
+            samples = samples << 1 | bits[..., i]
+    else:
+        samples = rows
+    return samples[:, :width * channels], pos
+
+def decode(data):
+    """
+    decode(data: bytes) -> (array, array)
+
+    Decode a PNG image to (rgb, alpha) arrays of shape (width, height, 3) and
+    (width, height) with 8 bits per sample, like pygame's surfarray. 16-bit
+    samples keep their high byte.
+    """
+    if not data.startswith(signature):
+        raise ValueError('not a PNG image')
+    idat, palette, trns = [], None, None
+    for kind, body in _chunks(data):
+        if kind == b'IHDR':
+            width, height, depth, color, comp, filt, interlace = \
+                struct.unpack('>IIBBBBB', body)
+        elif kind == b'PLTE':
+            palette = numpy.frombuffer(body, dtype=numpy.uint8).reshape(-1, 3)
+        elif kind == b'tRNS':
+            trns = body
+        elif kind == b'IDAT':
+            idat.append(body)
+    channels = _channels[color]
+    raw = zlib.decompress(b''.join(idat))
+
+    samples = numpy.zeros((height, width, channels), dtype=numpy.uint16)
+    if interlace:
+        pos = 0
+        for xs, ys, xstep, ystep in _adam7:
+            w, h = (width - xs + xstep - 1) // xstep, \
+                (height - ys + ystep - 1) // ystep
+            if w == 0 or h == 0:
+                continue
+            part, pos = _read_pass(raw, pos, w, h, depth, channels)
+            samples[ys::ystep, xs::xstep] = part.reshape(h, w, channels)
+    else:
+        part, pos = _read_pass(raw, 0, width, height, depth, channels)
+        samples[:] = part.reshape(height, width, channels)
+
+    rgba = numpy.empty((height, width, 4), dtype=numpy.uint8)
+    rgba[..., 3] = 255
+    if color == 3:
+        rgba[..., :3] = palette[samples[..., 0]]
+        if trns is not None:
+            alphas = numpy.full(len(palette), 255, dtype=numpy.uint8)
+            alphas[:len(trns)] = numpy.frombuffer(trns, dtype=numpy.uint8)
+            rgba[..., 3] = alphas[samples[..., 0]]
+        return _split(rgba)
+    top = (1 << depth) - 1
+    scaled = (samples if depth == 8 else samples >> 8 if depth == 16
+              else samples * 255 // top).astype(numpy.uint8)
+    if color in (0, 4):
+        rgba[..., :3] = scaled[..., :1]
+    else:
+        rgba[..., :3] = scaled[..., :3]
+    if color in (4, 6):
+        rgba[..., 3] = scaled[..., -1]
+    elif trns is not None:
+        key = struct.unpack('>{}H'.format(channels), trns[:2 * channels])
+        rgba[..., 3][numpy.all(samples == key, axis=2)] = 0
+    return _split(rgba)
+
+def _split(rgba):
+    rgba = rgba.transpose(1, 0, 2)
+    return (rgba[..., :3], rgba[..., 3])
+
+def encode(rgb, alpha, level=6):
+    """
+    encode(rgb: array, alpha: array, level: int = 6) -> bytes
+
+    Encode (rgb, alpha) arrays shaped like the ones decode returns as an
+    8-bit RGBA PNG image.
+    """
+    width, height = alpha.shape
+    rows = numpy.zeros((height, 1 + width * 4), dtype=numpy.uint8)
+    pixels = rows[:, 1:].reshape(height, width, 4)
+    pixels[..., :3] = numpy.asarray(rgb).transpose(1, 0, 2)
+    pixels[..., 3] = numpy.asarray(alpha).T
+
+    def chunk(kind, body):
+        return struct.pack('>I', len(body)) + kind + body + struct.pack(
+            '>I', zlib.crc32(kind + body) & 0xffffffff)
+    return signature + \
+        chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)) + \
+        chunk(b'IDAT', zlib.compress(rows.tobytes(), level)) + \
+        chunk(b'IEND', b'')
@@ -25,6 +25,7 @@ Primitive waves.
 
 import math
 from fractions import Fraction
+import numpy
 
 cdef double _pi2
 _pi2 = 2.0 * math.pi
@@ -71,3 +72,382 @@ def getlengths(double freq):
     quarter_wave_len = half_wave_len / 2
     three_quarter_wave_len = quarter_wave_len * 3
     return (quarter_wave_len, half_wave_len, three_quarter_wave_len, wave_len)
+
+def sine_array(t, freq, quarter_wave_len, half_wave_len,
+               three_quarter_wave_len, wave_len):
+    """Like sine, but t and the lengths may be broadcastable arrays."""
+    return numpy.sin(t * _pi2 * freq)
+
+def triangle_array(t, freq, quarter_wave_len, half_wave_len,
+                   three_quarter_wave_len, wave_len):
+    """Like triangle, but t and the lengths may be broadcastable arrays."""
+    tr = t % wave_len
+    return numpy.select(
+        (tr < quarter_wave_len, tr < half_wave_len,
+         tr < three_quarter_wave_len),
+        (tr / quarter_wave_len, 1 - (tr - quarter_wave_len) / quarter_wave_len,
+         -(tr - half_wave_len) / quarter_wave_len),
+        (tr - three_quarter_wave_len) / quarter_wave_len - 1)
+
+def square_array(t, freq, quarter_wave_len, half_wave_len,
+                 three_quarter_wave_len, wave_len):
+    """Like square, but t and the lengths may be broadcastable arrays."""
+    return numpy.where(t % wave_len < half_wave_len, 1.0, -1.0)
+
+def sawtooth_array(t, freq, quarter_wave_len, half_wave_len,
+                   three_quarter_wave_len, wave_len):
+    """Like sawtooth, but t and the lengths may be broadcastable arrays."""
+    tr = t % wave_len
+    return numpy.where(tr < half_wave_len, tr / half_wave_len,
+                       (tr - half_wave_len) / half_wave_len - 1)
+
+# The order in which hue moves through the waves, see README.txt
+wave_arrays = (sine_array, triangle_array, square_array, sawtooth_array)
+
+def polyblep(phase, step):
+    """
+    polyblep(phase: array, step: array) -> array
+
+    Get the polynomial band-limited step residual of a wave that jumps by 2
+    at phase 0, at phases between 0 and 1 that advance by step every sample.
+    Adding it times half the jump of a wave at its jump rounds the jump off
+    over the sample before and the sample after it.
+    """
+    x = phase / step
+    y = (phase - 1) / step
+    return numpy.where(phase < step, 2 * x - x * x - 1,
+                       numpy.where(phase > 1 - step, y * y + 2 * y + 1, 0.0))
+
+def polyblamp(phase, step):
+    """
+    polyblamp(phase: array, step: array) -> array
+
+    Like polyblep, but for a wave whose slope per sample goes up by 2 at
+    phase 0; the integral of the step residual.
+    """
+    d = numpy.abs((phase + 0.5) % 1 - 0.5) / step
+    return numpy.where(d < 1, (1 - numpy.minimum(d, 1)) ** 3 / 3, 0.0)
+
+def sine_blep_array(t, freq, quarter_wave_len, half_wave_len,
+                    three_quarter_wave_len, wave_len, step):
+    """Like sine_array; a sine has nothing to smooth."""
+    return sine_array(t, freq, quarter_wave_len, half_wave_len,
+                      three_quarter_wave_len, wave_len)
+
+def triangle_blep_array(t, freq, quarter_wave_len, half_wave_len,
+                        three_quarter_wave_len, wave_len, step):
+    """
+    Like triangle_array, but with the corners rounded off by polyblamp for
+    phases that advance by step every sample.
+    """
+    phase = (t % wave_len) / wave_len
+    return triangle_array(t, freq, quarter_wave_len, half_wave_len,
+                          three_quarter_wave_len, wave_len) + \
+        4 * step * (polyblamp((phase - 0.75) % 1, step) -
+                    polyblamp((phase - 0.25) % 1, step))
+
+def square_blep_array(t, freq, quarter_wave_len, half_wave_len,
+                      three_quarter_wave_len, wave_len, step):
+    """
+    Like square_array, but with the edges rounded off by polyblep for phases
+    that advance by step every sample.
+    """
+    phase = (t % wave_len) / wave_len
+    return square_array(t, freq, quarter_wave_len, half_wave_len,
+                        three_quarter_wave_len, wave_len) + \
+        polyblep(phase, step) - polyblep((phase + 0.5) % 1, step)
+
+def sawtooth_blep_array(t, freq, quarter_wave_len, half_wave_len,
+                        three_quarter_wave_len, wave_len, step):
+    """
+    Like sawtooth_array, but with the edge rounded off by polyblep for phases
+    that advance by step every sample.
+    """
+    phase = (t % wave_len) / wave_len
+    return sawtooth_array(t, freq, quarter_wave_len, half_wave_len,
+                          three_quarter_wave_len, wave_len) - \
+        polyblep((phase + 0.5) % 1, step)
+
+# The waves of wave_arrays with less aliasing; they take the phase step per
+# sample as an extra argument
+blep_arrays = (sine_blep_array, triangle_blep_array, square_blep_array,
+               sawtooth_blep_array)
+
+def _mean_product(a, b):
+    # The mean over one period of the product of two waves of wave_arrays
+    t = (numpy.arange(1 << 12) + 0.5) / (1 << 12)
+    return float(numpy.mean(wave_arrays[a](t, 1.0, 0.25, 0.5, 0.75, 1.0) *
+                            wave_arrays[b](t, 1.0, 0.25, 0.5, 0.75, 1.0)))
+
+# The mean square of each wave in wave_arrays, and the mean product of each
+# wave and the next, which a hue between them mixes
+mean_squares = tuple(_mean_product(k, k) for k in range(len(wave_arrays)))
+mean_products = tuple(_mean_product(k, (k + 1) % len(wave_arrays))
+                      for k in range(len(wave_arrays)))
+
+_wavetables = {}
+
+def wavetable(int kind, int size, harmonics=None):
+    """
+    wavetable(kind: int, size: int, harmonics: int = None) -> array
+
+    Get one cycle of the wave at index kind in wave_arrays, sampled at size
+    points, followed by a copy of the first point to ease interpolation. If
+    harmonics is given, sum the wave's Fourier series up to that harmonic
+    instead, which makes the wave band-limited. Tables are cached.
+    """
+    key = (kind, size, harmonics)
+    try:
+        return _wavetables[key]
+    except KeyError:
+        pass
+    p = numpy.arange(size + 1, dtype=numpy.float64) / size
+    if harmonics is None or kind == 0:
+        table = wave_arrays[kind](p, 1.0, 0.25, 0.5, 0.75, 1.0)
+    else:
+        harmonics = max(harmonics, 1)
+        n = numpy.arange(1, harmonics + 1, dtype=numpy.float64)
+        table = numpy.dot(harmonic_series(kind, harmonics),
+                          numpy.sin(_pi2 * n[:, None] * p))
+    table[-1] = table[0]
+    _wavetables[key] = table
+    return table
+
+_wave_peaks = {}
+
+# The limit of the overshoot of a Fourier series at a jump, as a fraction of
+# half the jump: 2 / pi * Si(pi)
+_gibbs = 1.1789797444721672
+
+def wave_peak(int kind, harmonics=None):
+    """
+    wave_peak(kind: int, harmonics: int = None) -> float
+
+    Get the largest absolute value of the wave at index kind in wave_arrays,
+    or, if harmonics is given, of the sum of its Fourier series up to that
+    harmonic, which overshoots at the edges of the wave. Sums of more than 64
+    harmonics are bounded by the larger of the sum of 64 and the limit of the
+    overshoot.
+    """
+    if harmonics is None or kind == 0:
+        return 1.0
+    if harmonics > 64:
+        return max(wave_peak(kind, 64), _gibbs if kind > 1 else 1.0)
+    key = (kind, max(harmonics, 1))
+    try:
+        return _wave_peaks[key]
+    except KeyError:
+        pass
+    p = numpy.arange(1 << 12, dtype=numpy.float64) / (1 << 12)
+    n = numpy.arange(1, key[1] + 1, dtype=numpy.float64)
+    peak = float(numpy.abs(numpy.dot(harmonic_series(kind, key[1]),
+                                     numpy.sin(_pi2 * n[:, None] * p))).max())
+    _wave_peaks[key] = peak
+    return peak
+
+def harmonic_series(int kind, int harmonics):
+    """
+    harmonic_series(kind: int, harmonics: int) -> array
+
+    Get the amplitudes of the sines at 1 to harmonics times the frequency that
+    sum to the wave at index kind in wave_arrays (exactly for the sine, and in
+    the limit for the others).
+    """
+    n = numpy.arange(1, harmonics + 1, dtype=numpy.float64)
+    if kind == 0: # sine
+        return numpy.where(n == 1, 1.0, 0)
+    elif kind == 1: # triangle
+        return numpy.where(n % 2 == 1, 8 / math.pi ** 2 / n ** 2, 0) * \
+            numpy.where(n % 4 == 3, -1, 1)
+    elif kind == 2: # square
+        return numpy.where(n % 2 == 1, 4 / math.pi / n, 0)
+    else: # sawtooth
+        return 2 / math.pi / n * numpy.where(n % 2 == 1, 1, -1)
+
+class WavetableBank:
+    """
+    A bank of table lookup oscillators, one for each frequency in freqs.
+
+    Phases are 32-bit fixed-point numbers computed from the absolute sample
+    number, so they neither drift on long renders nor depend on which samples
+    were rendered before. peaks holds the largest absolute value of every wave
+    of every oscillator, as an array of shape (waves, oscillators). If
+    bandlimited, every octave of freqs, counted from
+    the lowest frequency, gets its own tables, which only contain the harmonics
+    that stay below the Nyquist frequency at the top of the octave.
+    """
+
+    def __init__(self, freqs, int framerate, bandlimited=False, int bits=12):
+        self.freqs = numpy.asarray(freqs, dtype=numpy.float64)
+        self.framerate = framerate
+        self.increments = numpy.round(
+            self.freqs * 2.0 ** 32 / framerate).astype(numpy.uint64)
+        self._shift = numpy.uint64(32 - bits)
+        self._mask = numpy.uint64((1 << (32 - bits)) - 1)
+        self._scale = 1.0 / (1 << (32 - bits))
+        self._size = (1 << bits) + 1
+        if not bandlimited or not len(self.freqs):
+            self.octaves = None
+            self.tables = tuple(wavetable(k, 1 << bits)
+                                for k in range(len(wave_arrays)))
+            self.peaks = numpy.ones((len(wave_arrays), len(self.freqs)))
+            return
+        self.octaves = numpy.log2(self.freqs / self.freqs.min()).astype(
+            numpy.intp)
+        tops = self.freqs.min() * 2.0 ** numpy.arange(
+            1, self.octaves.max() + 2)
+        harmonics = [max(1, min(int(framerate / 2 / top), (1 << bits) // 2 - 1))
+                     for top in tops]
+        # The tables of each wave, one octave after the other
+        self.tables = tuple(numpy.concatenate([wavetable(k, 1 << bits, h)
+                                               for h in harmonics])
+                            for k in range(len(wave_arrays)))
+        self.peaks = numpy.array([[wave_peak(k, h) for h in harmonics]
+                                  for k in range(len(wave_arrays))])[
+            :, self.octaves]
+
+    def phases(self, rows, start, int length):
+        """
+        phases(rows: array, start: int, length: int) -> array
+
+        Get the phases of the oscillators at index rows for the samples from
+        start to start + length, as an array of shape (len(rows), length).
+        """
+        n = numpy.arange(start, start + length, dtype=numpy.uint64)
+        return (n * self.increments[rows, None]) & numpy.uint64(0xffffffff)
+
+    def render(self, int kind, rows, start, int length):
+        """
+        render(kind: int, rows: array, start: int, length: int) -> array
+
+        Like phases, but get the values of the wave at index kind in
+        wave_arrays, linearly interpolated between table entries.
+        """
+        phase = self.phases(rows, start, length)
+        index = phase >> self._shift
+        frac = (phase & self._mask).astype(numpy.float64) * self._scale
+        if self.octaves is not None:
+            index += (self.octaves[rows] * self._size).astype(
+                numpy.uint64)[:, None]
+        table = self.tables[kind]
+        low = table[index]
+        return low + (table[index + 1] - low) * frac
+
+def _hann_spectrum(nu, int size):
+    # The DFT of a periodic Hann window of size samples times a complex
+    # sinusoid, at nu bins from the sinusoid's frequency.
+    def dirichlet(v):
+        den = numpy.sin(math.pi * v / size)
+        small = numpy.abs(den) < 1e-12
+        ratio = numpy.where(small, size, numpy.sin(math.pi * v) /
+                            numpy.where(small, 1, den))
+        return numpy.exp(1j * math.pi * v * (size - 1) / size) * ratio
+    return 0.5 * dirichlet(nu) - 0.25 * (dirichlet(nu + 1) +
+                                         dirichlet(nu - 1))
+
+class SpectralBank:
+    """
+    Oscillators, one for each frequency in freqs, synthesized in the frequency
+    domain a frame at a time.
+
+    A frame is 2 * length samples, starting length // 2 samples before a
+    column of length samples, and Hann-windowed, so that the frames of
+    consecutive columns overlap-add to the sound. Every sine (the
+    triangle, square and sawtooth waves are sums of harmonic sines, up to the
+    Nyquist frequency) is written into the spectrum of the frame as the
+    transform of a windowed sine, over the bins nearest to its frequency,
+    and the frame is made with an inverse FFT. The transforms are
+    interpolated from a table of steps transforms between two bins. Like in
+    WavetableBank, phases are computed from the absolute sample number, and
+    peaks holds the largest absolute value of every wave of every
+    oscillator.
+    """
+
+    def __init__(self, freqs, int framerate, int length, int bins=16,
+                 int steps=256):
+        self.freqs = numpy.asarray(freqs, dtype=numpy.float64)
+        self.framerate = framerate
+        self.size = 2 * length
+        self.offset = length // 2
+        self.steps = steps
+        harmonics = max(1, int(framerate / 2 / self.freqs.min())
+                        if len(self.freqs) else 1)
+        self.coefs = numpy.array([harmonic_series(k, harmonics)
+                                  for k in range(len(wave_arrays))])
+        # Every partial, that is every harmonic of every oscillator below the
+        # Nyquist frequency, with its position in bins
+        numbers = numpy.arange(1, harmonics + 1)
+        osc, num = numpy.nonzero(self.freqs[:, None] * numbers <
+                                 framerate / 2)
+        self.partial_oscillators, self.partial_numbers = osc, num + 1
+        pos = self.freqs[osc] * (num + 1) * self.size / framerate
+        centre = numpy.rint(pos)
+        step = (pos - centre + 0.5) * steps
+        self.partial_steps = numpy.minimum(step.astype(numpy.int64),
+                                           steps - 1)
+        self.partial_fracs = step - self.partial_steps
+        self.partial_bins = centre.astype(numpy.int64)[:, None] + \
+            numpy.arange(-bins, bins + 1)
+        # The partials with bins at or beyond 0 or size // 2 (see render)
+        self.partial_edges = (centre - bins <= 0) | \
+            (centre + bins >= length)
+        # Halved: a real frame has half the spectrum of the complex one
+        self.kernels = _hann_spectrum(
+            numpy.linspace(-0.5, 0.5, steps + 1)[:, None] -
+            numpy.arange(-bins, bins + 1), self.size) / 2
+        counts = numpy.bincount(osc, minlength=len(self.freqs))
+        self.peaks = numpy.array([[wave_peak(k, h) for h in counts]
+                                  for k in range(len(wave_arrays))])
+
+    def render(self, weights, start):
+        """
+        render(weights: array, start: int) -> array
+
+        Get the frame for the column starting at sample number start of the
+        oscillators weighted by weights, an array of shape (waves,
+        oscillators, channels) with the weight of each wave in wave_arrays
+        for each oscillator and channel. The frame has the shape
+        (2 * length, channels).
+        """
+        cdef int size = self.size, half = self.size // 2
+        channels = weights.shape[2]
+        frame = numpy.zeros((size, channels))
+        sel = numpy.flatnonzero(
+            weights.any(axis=(0, 2))[self.partial_oscillators])
+        if not len(sel):
+            return frame
+        osc, num = self.partial_oscillators[sel], self.partial_numbers[sel]
+        # Sum the amplitudes of every partial over the waves
+        amp = numpy.einsum('kpc,kp->pc', weights[:, osc],
+                           self.coefs[:, num - 1])
+        keep = numpy.flatnonzero(amp.any(axis=1))
+        sel, osc, num, amp = sel[keep], osc[keep], num[keep], amp[keep]
+        first = (self.freqs[osc] * (start - self.offset) /
+                 self.framerate) % 1
+        # A sine is the real part of the complex sinusoid turned back a
+        # quarter.
+        rot = numpy.exp(1j * (_pi2 * ((first * num) % 1) - math.pi / 2))
+        step, frac = self.partial_steps[sel], self.partial_fracs[sel, None]
+        low = self.kernels[step]
+        kernel = (low + (self.kernels[step + 1] - low) * frac) * rot[:, None]
+        # The real frame has the spectrum halfway between this one and its
+        # mirror image conjugated. The inverse real FFT only needs its bins up
+        # to size // 2, so a tap beyond goes to its mirror bin conjugated
+        # instead; both halves meet at bins 0 and size // 2.
+        where = self.partial_bins[sel]
+        edges = numpy.flatnonzero(self.partial_edges[sel])
+        if len(edges):
+            folded, taps = where[edges] % size, kernel[edges]
+            upper = folded > half
+            folded[upper] = size - folded[upper]
+            taps[upper] = taps[upper].conj()
+            taps[(folded == 0) | (folded == half)] *= 2
+            where[edges], kernel[edges] = folded, taps
+        where = where.ravel()
+        spectrum = numpy.empty((channels, half + 1), dtype=numpy.complex128)
+        for c in range(channels):
+            v = (kernel * amp[:, c, None]).ravel()
+            spectrum[c] = numpy.bincount(where, v.real, half + 1) + \
+                1j * numpy.bincount(where, v.imag, half + 1)
+        frame[:] = numpy.fft.irfft(spectrum, size).T
+        return frame
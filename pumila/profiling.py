@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+# pumila: convert images to sound waves
+# Copyright (C) 2011 Niels Serup
+
+# This file is part of pumila.
+
+# pumila is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# pumila is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with pumila.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Measures where the time and memory of a render go.
+"""
+
+import time
+import cProfile
+import tracemalloc
+import collections
+
+from . import misc
+from . import info
+
+_selfdict, log = misc.get_selfdict(__name__), misc.newlog('profiling')
+info.add_metadata(_selfdict)
+
+clock = time.perf_counter
+
+class _Timer:
+    def __init__(self, stats, stage):
+        self.stats, self.stage = stats, stage
+
+    def __enter__(self):
+        self.start = clock()
+
+    def __exit__(self, *exc):
+        self.stats.seconds[self.stage] += clock() - self.start
+
+class _NoTimer:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+_no_timer = _NoTimer()
+
+class Stats:
+    """
+    Seconds spent in and counts of things done by the stages of a render.
+    When not enabled, nothing is measured, and every method returns at once;
+    code in loops should check enabled itself.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.seconds = collections.Counter()
+        self.counts = collections.Counter()
+
+    def timer(self, stage):
+        """Get a context manager adding the time spent in it to stage."""
+        return _Timer(self, stage) if self.enabled else _no_timer
+
+    def lap(self, stage, start):
+        """
+        lap(stage: str, start: float) -> float
+
+        Add the time since start (a clock value) to stage and return the
+        clock. Only call it when enabled.
+        """
+        now = clock()
+        self.seconds[stage] += now - start
+        return now
+
+    def count(self, key, n=1):
+        if self.enabled:
+            self.counts[key] += n
+
+    def as_dict(self):
+        """Get the seconds and counts as a dict of dicts."""
+        return {'seconds': dict(self.seconds), 'counts': dict(self.counts)}
+
+class Profile:
+    """
+    Profile the calls (with cProfile) and memory allocations (with
+    tracemalloc) of the code between start and stop. stop saves the profile
+    to path, to be read by the pstats module, and the allocations to path
+    + '.tracemalloc', to be read by tracemalloc.Snapshot.load.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        tracemalloc.start()
+        self.profile.enable()
+
+    def stop(self):
+        """
+        stop() -> int
+
+        Stop profiling, save the results and return the peak traced memory
+        use in bytes.
+        """
+        self.profile.disable()
+        snapshot = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        self.profile.dump_stats(self.path)
+        snapshot.dump(self.path + '.tracemalloc')
+        return peak
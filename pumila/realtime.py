@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+# pumila: convert images to sound waves
+# Copyright (C) 2011 Niels Serup
+
+# This file is part of pumila.
+
+# pumila is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# pumila is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with pumila.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Plays sound while it is being generated.
+"""
+
+import time
+import threading
+import numpy
+import pygame
+
+from . import misc
+
+class RingBuffer:
+    """
+    A ring buffer of 16-bit frames for one producer and one consumer. Only the
+    producer advances written and only the consumer advances read, so no lock
+    is needed.
+    """
+
+    def __init__(self, capacity, channels):
+        self.capacity = capacity
+        self.data = numpy.zeros((capacity, channels), dtype=numpy.int16)
+        self.written, self.read = 0, 0
+        self.closed = False
+
+    def available(self):
+        """Get the number of frames that can be read."""
+        return self.written - self.read
+
+    def put(self, frames, full=None):
+        """
+        Write an array of frames, waiting while the buffer is full. If
+        given, full() is called whenever it is, before waiting.
+        """
+        i = 0
+        while i < len(frames):
+            n = min(self.capacity - self.available(), len(frames) - i)
+            if n == 0:
+                if full is not None:
+                    full()
+                time.sleep(0.001)
+                continue
+            self._copy(self.written, frames[i:i + n], True)
+            self.written += n
+            i += n
+
+    def get(self, n):
+        """Read up to n frames without waiting."""
+        n = min(n, self.available())
+        frames = numpy.empty((n, self.data.shape[1]), dtype=numpy.int16)
+        self._copy(self.read, frames, False)
+        self.read += n
+        return frames
+
+    def _copy(self, pos, frames, into):
+        start = pos % self.capacity
+        first = min(len(frames), self.capacity - start)
+        parts = ((slice(start, start + first), slice(0, first)),
+                 (slice(0, len(frames) - first), slice(first, len(frames))))
+        for ring, outside in parts:
+            if into:
+                self.data[ring] = frames[outside]
+            else:
+                frames[outside] = self.data[ring]
+
+class Player:
+    """
+    Play frames on a mixer channel while they are being generated.
+
+    The first calibration seconds of writes measure how fast frames are
+    generated. From that, the player works out how many frames must be
+    buffered before playback starts for the producer to stay ahead of the
+    mixer for the rest of the nframes frames, and sizes its ring buffer
+    accordingly. A feeder thread then queues chunk frames at a time on the
+    channel; when fewer frames than that are ready, it counts an underrun and
+    fills up with silence.
+    """
+
+    def __init__(self, channel, framerate, channels, nframes, chunk=1024,
+                 calibration=0.25, min_latency=0.1, log=misc.donothing):
+        self.channel, self.framerate, self.channels, self.nframes = \
+            channel, framerate, channels, nframes
+        self.chunk, self.calibration, self.min_latency, self.log = \
+            chunk, calibration, min_latency, log
+        self.ring = None
+        self.feeder = None
+        self.latency = 0
+        self.underruns = 0
+        self.min_margin = None
+        self._pending, self._npending = [], 0
+        # Rendering the first block counts towards the measured speed
+        self._start = time.time()
+
+    def write(self, data):
+        """Add 16-bit interleaved samples, waiting while the buffer is full."""
+        frames = data.reshape(-1, self.channels)
+        if self.ring is None:
+            self._pending.append(frames)
+            self._npending += len(frames)
+            elapsed = time.time() - self._start
+            if elapsed >= self.calibration:
+                self._setup(elapsed)
+            return
+        self.ring.put(frames, self._full)
+        if self.feeder is None and self.ring.available() >= self._target:
+            self._start_feeder()
+
+    def _full(self):
+        # A block larger than the free space must not wait for a feeder
+        # that has not been started yet.
+        if self.feeder is None:
+            self._start_feeder()
+
+    def _setup(self, elapsed):
+        speed = self._npending / self.framerate / elapsed if elapsed else 0
+        # Leave a quarter of the measured speed as a safety margin.
+        safe = speed * 0.75
+        rest = self.nframes - self._npending
+        needed = rest * (1 - safe) / safe if 0 < safe < 1 else 0
+        if safe == 0:
+            needed = rest
+        self._target = int(max(needed, self.min_latency * self.framerate,
+                               self.chunk))
+        self._target = min(self._target, self.nframes)
+        self.latency = self._target / self.framerate
+        self.log('Generating {:.2f} times faster than real time; buffering '
+                 '{:.0f} ms before playing.'.format(speed, 1000 * self.latency))
+        capacity = max(self._target, self._npending) + 4 * self.chunk
+        self.ring = RingBuffer(capacity, self.channels)
+        pending, self._pending = self._pending, None
+        for frames in pending:
+            self.ring.put(frames, self._full)
+        if self.ring.available() >= self._target:
+            self._start_feeder()
+
+    def _start_feeder(self):
+        self.log('Starting playback...')
+        self.feeder = threading.Thread(target=self._feed)
+        self.feeder.daemon = True
+        self.feeder.start()
+
+    def _feed(self):
+        wait = self.chunk / self.framerate / 4
+        while True:
+            if self.channel.get_queue() is not None:
+                time.sleep(wait)
+                continue
+            margin = self.ring.available()
+            if margin == 0 and self.ring.closed:
+                break
+            if not self.ring.closed and (self.min_margin is None or
+                                         margin < self.min_margin):
+                self.min_margin = margin
+            frames = self.ring.get(self.chunk)
+            if len(frames) < self.chunk and not self.ring.closed:
+                self.underruns += 1
+                self.log('Underrun: only {} of {} frames were ready.'.format(
+                        len(frames), self.chunk), warning=True)
+                frames = numpy.concatenate((frames, numpy.zeros(
+                            (self.chunk - len(frames), self.channels),
+                            dtype=numpy.int16)))
+            self.channel.queue(pygame.sndarray.make_sound(
+                    frames if self.channels > 1 else frames[:, 0]))
+        while self.channel.get_busy():
+            time.sleep(wait)
+
+    def close(self):
+        """Mark the end of the sound and wait until it has been played."""
+        if self.ring is None:
+            self._setup(time.time() - self._start)
+        self.ring.closed = True
+        if self.feeder is None:
+            self._start_feeder()
+        self.feeder.join()
+        self.min_margin = (self.min_margin if self.min_margin is not None
+                           else self.ring.capacity) / self.framerate
@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+
+# pumila: convert images to sound waves
+# Copyright (C) 2011 Niels Serup
+
+# This file is part of pumila.
+
+# pumila is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# pumila is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with pumila.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Renders sound for clients over HTTP, on localhost or a Unix domain socket.
+
+POST /render takes a JSON object like
+
+  {"inputs": ["examples/test1.png/gain=0.5",
+              {"path": "examples/test2.png", "settings": {"min": "300 Hz"}},
+              {"data": "<base64 image>", "name": "upload.png"}],
+   "options": {"engine": "numpy", "pixelduration": 5},
+   "format": "wav"}
+
+and answers with the sound as it is generated, as a WAVE file or, with the
+format "pcm", as bare samples. The options are SoundCore keyword arguments
+(see render_options). GET /status answers with the state of the server as
+JSON.
+"""
+
+import sys
+import os
+import json
+import base64
+import hashlib
+import shutil
+import tempfile
+import threading
+import collections
+import socketserver
+import http.server
+from optparse import OptionParser
+
+from . import core
+from . import batch
+from . import image
+from . import misc
+from . import info
+
+_selfdict, log = misc.get_selfdict(__name__), misc.newlog('server')
+info.add_metadata(_selfdict)
+
+# The SoundCore keyword arguments a request can give
+render_options = ('channels', 'samplewidth', 'sampleformat', 'framerate',
+                  'pixelduration', 'fullduration', 'engine', 'blocksize',
+                  'stream', 'phasereset', 'imagebackend',
+                  'normalization', 'normlevel', 'ramp', 'rampshape',
+                  'bandlimited')
+
+class ImageCache:
+    """
+    Decoded images, the size most recently used ones of them, shared by all
+    requests. Use its load method as a SoundCore loader.
+    """
+
+    def __init__(self, size=32):
+        self.size = size
+        self._images = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self, path, backend=None):
+        """Like image.load, but reuse the image if the file is unchanged."""
+        st = os.stat(path)
+        key = (os.path.abspath(path), backend, st.st_mtime, st.st_size)
+        with self._lock:
+            try:
+                self._images.move_to_end(key)
+                return self._images[key]
+            except KeyError:
+                pass
+        loaded = image.load(path, backend)
+        with self._lock:
+            self._images[key] = loaded
+            while len(self._images) > self.size:
+                self._images.popitem(last=False)
+        return loaded
+
+    def __len__(self):
+        return len(self._images)
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    server_version = '{}/{}'.format(info.program.name,
+                                    info.program.version.text)
+
+    def address_string(self):
+        # Unix domain socket clients have no address
+        return self.client_address[0] if self.client_address else 'local'
+
+    def log_message(self, format, *args):
+        self.server.renderer.log('{} {}'.format(self.address_string(),
+                                                format % args))
+
+    def _reply(self, code, obj):
+        body = (json.dumps(obj, sort_keys=True) + '\n').encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', len(body))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != '/status':
+            return self._reply(404, {'error': 'not found'})
+        self._reply(200, self.server.renderer.status())
+
+    def do_POST(self):
+        if self.path != '/render':
+            return self._reply(404, {'error': 'not found'})
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length).decode())
+        except ValueError as e:
+            return self._reply(400, {'error': 'bad request: {}'.format(e)})
+        self.server.renderer.render(self, request)
+
+class Renderer:
+    def __init__(self, workers=2, queuesize=8, imagecache=32, cache=True,
+                 cachedir=None, cachesize=2 ** 30, verbose=False):
+        """
+        Render the requests of a server, at most workers at a time. At most
+        queuesize more requests wait for their turn; the ones after them are
+        turned away. Decoded images, the imagecache most recently used ones,
+        and the sound cache are shared by all requests. Uploaded images are
+        kept on disk while in use, and the imagecache most recently used of
+        the others too.
+        """
+        self.workers, self.queuesize = workers, queuesize
+        self.cache, self.cachedir, self.cachesize = cache, cachedir, cachesize
+        self.images = ImageCache(imagecache)
+        self.log = log if verbose else misc.donothing
+        self.uploads = tempfile.mkdtemp(prefix='pumila-server-')
+        # The uploaded files, least recently used first, and the number of
+        # requests using each
+        self._uploads = collections.OrderedDict()
+        self._uploadsize = imagecache
+        self._slots = threading.BoundedSemaphore(workers)
+        self._lock = threading.Lock()
+        self.counts = collections.Counter()
+
+    def status(self):
+        """Get the numbers of requests in each state and of cached images."""
+        with self._lock:
+            status = dict(self.counts)
+        status.update(workers=self.workers, queuesize=self.queuesize,
+                      images=len(self.images))
+        return status
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self.counts[key] += n
+
+    def _input(self, spec, uploads):
+        # Turn an input of a request into a SoundCore input file; add the
+        # uploads it uses to uploads
+        if isinstance(spec, str):
+            parsed = batch.parse_inputspec(spec)
+            if parsed is None:
+                raise ValueError('{} does not exist'.format(repr(spec)))
+            return parsed
+        if 'data' in spec:
+            data = base64.b64decode(spec['data'])
+            name = os.path.basename(spec.get('name', 'image.png'))
+            path = os.path.join(self.uploads, '{}-{}'.format(
+                    hashlib.sha256(data).hexdigest(), name))
+            with self._lock:
+                self._uploads[path] = self._uploads.get(path, 0) + 1
+                self._uploads.move_to_end(path)
+                uploads.append(path)
+            if not os.path.isfile(path):
+                with tempfile.NamedTemporaryFile(dir=self.uploads,
+                                                 delete=False) as f:
+                    f.write(data)
+                os.replace(f.name, path)
+        elif 'path' in spec:
+            path = spec['path']
+        else:
+            raise ValueError('an input needs a path or data')
+        return (path, dict(spec.get('settings', {})))
+
+    def _release(self, uploads):
+        # Let go of the uploads of a request, and remove the least recently
+        # used uploads no request is using beyond the ones to keep
+        with self._lock:
+            for path in uploads:
+                self._uploads[path] -= 1
+            unused = [path for path, users in self._uploads.items()
+                      if not users]
+            for path in unused[:max(0, len(self._uploads) - self._uploadsize)]:
+                del self._uploads[path]
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def _core(self, request, outputfile, uploads):
+        options = request.get('options', {})
+        for k in options:
+            if k not in render_options:
+                raise ValueError('{} is not an accepted option'.format(repr(k)))
+        inputs = [self._input(x, uploads) for x in request.get('inputs', ())]
+        if not inputs:
+            raise ValueError('no input file specified')
+        sc = core.SoundCore(
+            *inputs, outputfile=outputfile,
+            outputformat=request.get('format', 'wav'), cache=self.cache,
+            cachedir=self.cachedir, cachesize=self.cachesize,
+            loader=self.images.load, **options)
+        # Fail before the headers are sent, not after
+        sc.prepare()
+        return sc
+
+    def render(self, handler, request):
+        """Render the request of handler and send the sound to it."""
+        with self._lock:
+            if self.counts['pending'] >= self.queuesize + self.workers:
+                full = True
+            else:
+                full = False
+                self.counts['pending'] += 1
+        if full:
+            self._count('refused')
+            return handler._reply(503, {'error': 'the queue is full'})
+        try:
+            with self._slots:
+                self._count('running')
+                try:
+                    self._render(handler, request)
+                finally:
+                    self._count('running', -1)
+        finally:
+            self._count('pending', -1)
+
+    def _render(self, handler, request):
+        uploads = []
+        try:
+            self._respond(handler, request, uploads)
+        finally:
+            self._release(uploads)
+
+    def _respond(self, handler, request, uploads):
+        try:
+            sc = self._core(request, handler.wfile, uploads)
+        except (ValueError, TypeError, AttributeError, OSError,
+                ArithmeticError) as e:
+            self._count('failed')
+            return handler._reply(400, {'error': str(e) or repr(e)})
+        try:
+            handler.send_response(200)
+            handler.send_header('Content-Type', 'audio/wav'
+                                if sc.outputformat == 'wav'
+                                else 'application/octet-stream')
+            handler.send_header('X-Sample-Format', sc.sampleformat)
+            handler.send_header('X-Channels', sc.channels)
+            handler.send_header('X-Frame-Rate', sc.framerate)
+            handler.end_headers()
+            try:
+                sc.run()
+            except (BrokenPipeError, ConnectionResetError):
+                # The header cannot be corrected on a closed connection
+                try:
+                    sc.wavof.close()
+                except OSError:
+                    pass
+                sc.wavof = None
+                raise
+            finally:
+                sc.end()
+        except (BrokenPipeError, ConnectionResetError):
+            self._count('failed')
+            self.log('The client went away before the sound was done.')
+        except Exception as e:
+            # The headers are sent, so the client can only tell by the
+            # connection closing early.
+            self._count('failed')
+            log(e, error=True, traceback=True)
+        else:
+            self._count('done')
+
+    def close(self):
+        """Remove the uploaded images."""
+        shutil.rmtree(self.uploads, ignore_errors=True)
+
+class HTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, renderer):
+        http.server.HTTPServer.__init__(self, address, _Handler)
+        self.renderer = renderer
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, renderer):
+        socketserver.UnixStreamServer.__init__(self, path, _Handler)
+        self.renderer = renderer
+
+def parse_args(cmdargs=None):
+    """
+    parse_args(cmdargs: [str] = sys.argv[1:]) -> None
+
+    Serve with the options given on the command line until interrupted.
+    """
+    if cmdargs is None:
+        cmdargs = sys.argv[1:]
+
+    parser = OptionParser(
+        prog='pumila-server', usage='Usage: %prog [OPTION]...',
+        version=info.program.version_info,
+        description='Render sound for clients over HTTP. POST a JSON request '
+        'to /render to get the sound back while it is being generated, and '
+        'GET /status to see the state of the server.')
+    parser.add_option('-H', '--host', dest='host', default='127.0.0.1',
+                      help='the address to listen on. Defaults to 127.0.0.1.')
+    parser.add_option('-p', '--port', dest='port', type='int', default=8765,
+                      help='the port to listen on. Defaults to 8765.')
+    parser.add_option('-u', '--unix-socket', dest='socket', metavar='PATH',
+                      help='listen on the Unix domain socket PATH instead.')
+    parser.add_option('-j', '--jobs', dest='workers', type='int', default=2,
+                      help='the number of requests to render at a time. '
+                      'Defaults to 2.')
+    parser.add_option('-Q', '--queue-size', dest='queuesize', type='int',
+                      default=8, help='the number of requests that can wait '
+                      'for their turn; more are refused. Defaults to 8.')
+    parser.add_option('-I', '--image-cache', dest='imagecache', type='int',
+                      default=32, help='the number of decoded images, and of '
+                      'uploaded images no longer in use, to keep for later '
+                      'requests. Defaults to 32.')
+    parser.add_option('--cache-dir', dest='cachedir', metavar='DIRECTORY',
+                      help='the directory of the sound cache.')
+    parser.add_option('--cache-size', dest='cachesize', type='int',
+                      default=1024, metavar='MIB',
+                      help='the size of the sound cache. Defaults to 1024 MiB.')
+    parser.add_option('--no-cache', dest='cache', action='store_false',
+                      default=True, help='do not use the sound cache.')
+    parser.add_option('-q', '--quiet', dest='verbose', action='store_false',
+                      default=True, help='only log errors.')
+
+    o, args = parser.parse_args(cmdargs)
+    renderer = Renderer(o.workers, o.queuesize, o.imagecache, o.cache,
+                        o.cachedir, o.cachesize * 2 ** 20, o.verbose)
+    try:
+        if o.socket:
+            server = UnixServer(o.socket, renderer)
+            renderer.log('Listening on {}.'.format(o.socket))
+        else:
+            server = HTTPServer((o.host, o.port), renderer)
+            renderer.log('Listening on http://{}:{}/.'.format(
+                    *server.server_address[:2]))
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            if o.socket:
+                os.remove(o.socket)
+    finally:
+        renderer.close()